@@ -1,21 +1,43 @@
 import os
 import sqlite3
 import string
-import random
 import json
+import queue
+import bisect
+import html
+import heapq
+import re
+import calendar
+import logging
+import fcntl
+import mmap
+import shutil
+import tempfile
+import hashlib
 from flask import Flask, request, jsonify, render_template, session, redirect, url_for
 import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from datetime import datetime, timedelta
 from sendgrid import SendGridAPIClient
 from sendgrid.helpers.mail import Mail
 import threading
+import time
 from threading import Lock
 import base64
 import secrets
 from functools import wraps
+from contextlib import contextmanager
+from collections import OrderedDict, deque
+import atexit
+try:
+    import orjson
+except ImportError:
+    orjson = None
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
 
 # Import bot-related functions from bot.py
 from bot import bot, send_telegram, load_coupons, save_coupons, get_coupon, is_coupon_valid, use_coupon, start_bot
@@ -24,13 +46,24 @@ from bot import bot, send_telegram, load_coupons, save_coupons, get_coupon, is_c
 import webhooklog
 
 # =================== GitHub API Helper ===================
+# Shared pool for concurrent GitHub reads / blob uploads (kept under GitHub's concurrency limits)
+GITHUB_EXECUTOR = ThreadPoolExecutor(max_workers=8, thread_name_prefix="github")
+
 class GitHubDataManager:
     """Manage key and solved key data via GitHub API"""
     
+    _FILE_MAP = {
+        '1d': 'data/keys/key1d.txt',
+        '7d': 'data/keys/key7d.txt',
+        '30d': 'data/keys/key30d.txt',
+        '90d': 'data/keys/key90d.txt',
+    }
+    
     def __init__(self):
         self.token = os.environ.get('GITHUB_TOKEN', '')
         self.owner = os.environ.get('GITHUB_OWNER', 'nddev15')
         self.repo = os.environ.get('GITHUB_REPO', 'keys')
+        self.branch = os.environ.get('GITHUB_BRANCH') or 'main'
         self.api_base = 'https://api.github.com'
         self.use_github = bool(self.token and self.owner and self.repo)
         
@@ -43,18 +76,64 @@ class GitHubDataManager:
             'Authorization': f'token {self.token}',
             'Accept': 'application/vnd.github.v3+json',
         }
+        
+        # Keep-alive session so consecutive API calls reuse the TLS connection
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        self.session.mount('https://', HTTPAdapter(
+            pool_connections=10,
+            pool_maxsize=20,
+            max_retries=Retry(total=2, backoff_factor=0.3, status_forcelist=[502, 503, 504])
+        ))
+        
+        # Last known blob SHA per file, taken from our own PUT responses
+        self._sha_cache = {}
+        self._sha_cache_lock = Lock()
+        # {file_path: (etag, text)} from raw reads, revalidated with If-None-Match
+        self._content_cache = {}
+        # Read-modify-write of a repo file holds its lock, so concurrent updates
+        # don't commit over each other (or retry a stale SHA into a lost update)
+        self._file_locks = {}
+        self._file_locks_lock = Lock()
+    
+    @contextmanager
+    def _locked(self, *file_paths):
+        """Hold the write locks of file_paths, always taken in sorted order"""
+        with self._file_locks_lock:
+            locks = [self._file_locks.setdefault(path, Lock()) for path in sorted(set(file_paths))]
+        for lock in locks:
+            lock.acquire()
+        try:
+            yield
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
+    @staticmethod
+    def _git_blob_sha(raw):
+        """SHA-1 git gives a blob of these bytes (what the Contents API calls the file's sha)"""
+        return hashlib.sha1(b'blob %d\0' % len(raw) + raw).hexdigest()
 
     def _get_file_sha(self, file_path):
         """Get file SHA for update operations"""
         if not self.use_github:
             return None
         
+        with self._sha_cache_lock:
+            cached_sha = self._sha_cache.get(file_path)
+        if cached_sha:
+            return cached_sha
+        
         try:
             url = f'{self.api_base}/repos/{self.owner}/{self.repo}/contents/{file_path}'
-            response = requests.get(url, headers=self.headers, timeout=10)
+            response = self.session.get(url, timeout=10)
             
             if response.status_code == 200:
-                return response.json().get('sha')
+                sha = response.json().get('sha')
+                if sha:
+                    with self._sha_cache_lock:
+                        self._sha_cache[file_path] = sha
+                return sha
             elif response.status_code == 404:
                 return None
             else:
@@ -65,21 +144,48 @@ class GitHubDataManager:
             return None
 
     def _read_file_content(self, file_path):
-        """Read file content from GitHub"""
+        """Read file content from GitHub (also caches its blob SHA for the next write)"""
         if not self.use_github:
             return None
         
         try:
             url = f'{self.api_base}/repos/{self.owner}/{self.repo}/contents/{file_path}'
-            response = requests.get(
-                url,
-                headers={**self.headers, 'Accept': 'application/vnd.github.v3.raw'},
-                timeout=10
-            )
+            headers = {}
+            with self._sha_cache_lock:
+                cached = self._content_cache.get(file_path)
+            if cached:
+                # 304s are free against the rate limit and carry no body
+                headers['If-None-Match'] = cached[0]
+            # JSON (not raw) so the same GET returns the SHA a following PUT needs
+            response = self.session.get(url, headers=headers, timeout=10)
             
-            if response.status_code == 200:
-                return response.text
+            if response.status_code == 304 and cached:
+                return cached[1]
+            elif response.status_code == 200:
+                data = response.json()
+                sha = data.get('sha')
+                if data.get('encoding') == 'base64':
+                    text = base64.b64decode(data.get('content', '')).decode('utf-8')
+                else:
+                    # Files over 1 MB come back without inline content
+                    raw_resp = self.session.get(
+                        url, headers={'Accept': 'application/vnd.github.v3.raw'}, timeout=10
+                    )
+                    raw_resp.raise_for_status()
+                    text = raw_resp.text
+                etag = response.headers.get('ETag')
+                with self._sha_cache_lock:
+                    if etag:
+                        self._content_cache[file_path] = (etag, text)
+                    else:
+                        self._content_cache.pop(file_path, None)
+                    if sha:
+                        self._sha_cache[file_path] = sha
+                return text
             elif response.status_code == 404:
+                with self._sha_cache_lock:
+                    self._content_cache.pop(file_path, None)
+                    self._sha_cache.pop(file_path, None)
                 return ""
             else:
                 print(f"[GITHUB] Error reading file: {response.status_code}")
@@ -88,7 +194,7 @@ class GitHubDataManager:
             print(f"[GITHUB] Exception reading file: {e}")
             return None
 
-    def _write_file_content(self, file_path, content, commit_message):
+    def _write_file_content(self, file_path, content, commit_message, sha=None):
         """Write/update file content to GitHub"""
         if not self.use_github:
             return False
@@ -96,11 +202,21 @@ class GitHubDataManager:
         try:
             url = f'{self.api_base}/repos/{self.owner}/{self.repo}/contents/{file_path}'
             
-            sha = self._get_file_sha(file_path)
+            # Only use a SHA we already know (passed in, or cached by the last
+            # read/write); unknown files are PUT without one first
+            if not sha:
+                with self._sha_cache_lock:
+                    sha = self._sha_cache.get(file_path)
             
-            content_b64 = base64.b64encode(
-                content.encode('utf-8') if isinstance(content, str) else content
-            ).decode('utf-8')
+            # The Contents API only accepts base64; bytes callers skip the utf-8 encode
+            raw = content if isinstance(content, (bytes, bytearray)) else content.encode('utf-8')
+            
+            # Same bytes as the version we last read/wrote: a PUT would be a no-op commit
+            if sha and self._git_blob_sha(bytes(raw)) == sha:
+                print(f"[GITHUB] ℹ️  {file_path} unchanged, skipping commit")
+                return True
+            
+            content_b64 = base64.b64encode(raw).decode('ascii')
             
             payload = {
                 'message': commit_message,
@@ -110,11 +226,34 @@ class GitHubDataManager:
             if sha:
                 payload['sha'] = sha
             
-            response = requests.put(url, headers=self.headers, json=payload, timeout=10)
+            response = self.session.put(url, json=payload, timeout=10)
+            
+            if response.status_code in (409, 422):
+                # 422: file exists but no SHA was sent; 409: cached SHA is stale.
+                # Either way fetch the current SHA and retry once
+                with self._sha_cache_lock:
+                    self._sha_cache.pop(file_path, None)
+                sha = self._get_file_sha(file_path)
+                if sha:
+                    payload['sha'] = sha
+                else:
+                    payload.pop('sha', None)
+                response = self.session.put(url, json=payload, timeout=10)
             
             if response.status_code in [200, 201]:
                 print(f"[GITHUB] ✅ Updated {file_path}")
                 
+                # The PUT response carries the new SHA, so the next write skips the GET
+                try:
+                    new_sha = response.json()['content']['sha']
+                except Exception:
+                    new_sha = None
+                with self._sha_cache_lock:
+                    if new_sha:
+                        self._sha_cache[file_path] = new_sha
+                    else:
+                        self._sha_cache.pop(file_path, None)
+                
                 # Log to Discord
                 try:
                     import webhooklog
@@ -128,6 +267,8 @@ class GitHubDataManager:
                 
                 return True
             else:
+                with self._sha_cache_lock:
+                    self._sha_cache.pop(file_path, None)
                 print(f"[GITHUB] ❌ Failed to update {file_path}: {response.status_code}")
                 print(f"[GITHUB] Response: {response.text}")
                 
@@ -161,6 +302,149 @@ class GitHubDataManager:
             
             return False
 
+    def _batch_commit(self, changes, commit_message):
+        """
+        Commit several files at once via the Git Data API (blobs -> tree -> commit -> ref)
+        
+        changes: {file_path: new_text_content}. Returns True on success
+        """
+        if not self.use_github or not changes:
+            return False
+        
+        # Leave out files whose content already matches their last known blob
+        with self._sha_cache_lock:
+            known = {path: self._sha_cache.get(path) for path in changes}
+        changes = {
+            path: content for path, content in changes.items()
+            if not known[path] or self._git_blob_sha(content.encode('utf-8')) != known[path]
+        }
+        if not changes:
+            print("[GITHUB] ℹ️  No file changed, skipping commit")
+            return True
+        
+        repo_url = f'{self.api_base}/repos/{self.owner}/{self.repo}'
+        try:
+            ref_resp = self.session.get(f'{repo_url}/git/ref/heads/{self.branch}', timeout=10)
+            ref_resp.raise_for_status()
+            base_sha = ref_resp.json()['object']['sha']
+            
+            commit_resp = self.session.get(f'{repo_url}/git/commits/{base_sha}', timeout=10)
+            commit_resp.raise_for_status()
+            base_tree = commit_resp.json()['tree']['sha']
+            
+            def create_blob(content):
+                resp = self.session.post(
+                    f'{repo_url}/git/blobs',
+                    json={'content': content, 'encoding': 'utf-8'},
+                    timeout=10
+                )
+                resp.raise_for_status()
+                return resp.json()['sha']
+            
+            paths = list(changes)
+            blob_shas = list(GITHUB_EXECUTOR.map(lambda path: create_blob(changes[path]), paths))
+            
+            tree_resp = self.session.post(f'{repo_url}/git/trees', json={
+                'base_tree': base_tree,
+                'tree': [
+                    {'path': path, 'mode': '100644', 'type': 'blob', 'sha': blob_sha}
+                    for path, blob_sha in zip(paths, blob_shas)
+                ]
+            }, timeout=10)
+            tree_resp.raise_for_status()
+            
+            new_commit_resp = self.session.post(f'{repo_url}/git/commits', json={
+                'message': commit_message,
+                'tree': tree_resp.json()['sha'],
+                'parents': [base_sha]
+            }, timeout=10)
+            new_commit_resp.raise_for_status()
+            
+            update_resp = self.session.patch(
+                f'{repo_url}/git/refs/heads/{self.branch}',
+                json={'sha': new_commit_resp.json()['sha']},
+                timeout=10
+            )
+            update_resp.raise_for_status()
+        except Exception as e:
+            print(f"[GITHUB] ❌ Batch commit failed: {e}")
+            with self._sha_cache_lock:
+                for path in changes:
+                    self._sha_cache.pop(path, None)
+            try:
+                import webhooklog
+                webhooklog.log_github_sync(
+                    action=commit_message,
+                    file_path=', '.join(changes),
+                    success=False,
+                    error_msg=str(e)
+                )
+            except Exception as webhook_err:
+                print(f"[WEBHOOK] ⚠️ Failed to send Discord notification: {webhook_err}")
+            return False
+        
+        # Contents API SHAs are blob SHAs, so later single-file PUTs can reuse them
+        with self._sha_cache_lock:
+            self._sha_cache.update(zip(paths, blob_shas))
+        
+        print(f"[GITHUB] ✅ Committed {len(paths)} file(s) in one commit")
+        try:
+            import webhooklog
+            webhooklog.log_github_sync(
+                action=commit_message,
+                file_path=', '.join(paths),
+                success=True
+            )
+        except Exception as webhook_err:
+            print(f"[WEBHOOK] ⚠️ Failed to send Discord notification: {webhook_err}")
+        return True
+
+    def write_files(self, changes, commit_message):
+        """
+        Overwrite several files in one commit, falling back to one PUT per file
+        
+        changes: {file_path: new_text_content}. Returns True if every file was written
+        """
+        if not self.use_github or not changes:
+            return False
+        
+        with self._locked(*changes):
+            if self._batch_commit(changes, commit_message):
+                return True
+            print("[GITHUB] ⚠️  Batch commit failed, writing files one by one...")
+            results = [self._write_file_content(path, content, commit_message)
+                       for path, content in changes.items()]
+            return all(results)
+
+    def _process_one_file(self, file_path, key_to_delete):
+        """Read one key file from GitHub, returns its content without key_to_delete (None if unchanged)"""
+        try:
+            content = self._read_file_content(file_path)
+            
+            if content is None:
+                print(f"[GITHUB] ⚠️  Could not read {file_path}")
+                return None
+            
+            if not content:
+                print(f"[GITHUB] ℹ️  {file_path} is empty")
+                return None
+            
+            lines = [line.strip() for line in content.split('\n') if line.strip()]
+            
+            if key_to_delete not in lines:
+                print(f"[GITHUB] ℹ️  Key not found in {file_path}")
+                return None
+            
+            new_lines = [line for line in lines if line != key_to_delete]
+            new_content = '\n'.join(new_lines)
+            if new_lines:
+                new_content += '\n'
+            return new_content
+                
+        except Exception as e:
+            print(f"[GITHUB] ⚠️  Exception processing {file_path}: {e}")
+            return None
+
     def delete_key_and_save_solved(self, key_to_delete, email=None, uid=None, period=None, prices=None, coupon_used=False, coupon_code=None, discount=0):
         """Delete key from data/keys/*.txt and save to data/keys/keys_solved.json"""
         if not self.use_github:
@@ -168,63 +452,40 @@ class GitHubDataManager:
         
         print(f"[GITHUB] 🔄 Starting delete_key_and_save_solved for key: {key_to_delete}")
         
-        key_files = [
-            'data/keys/key1d.txt',
-            'data/keys/key7d.txt',
-            'data/keys/key30d.txt',
-            'data/keys/key90d.txt',
-        ]
-        
-        removed_from = []
+        key_files = list(self._FILE_MAP.values())
+        solved_file_path = 'data/keys/keys_solved.json'
         
-        for file_path in key_files:
-            try:
-                content = self._read_file_content(file_path)
-                
-                if content is None:
-                    print(f"[GITHUB] ⚠️  Could not read {file_path}")
-                    continue
-                
-                if not content:
-                    print(f"[GITHUB] ℹ️  {file_path} is empty")
-                    continue
-                
-                lines = [line.strip() for line in content.split('\n') if line.strip()]
-                
-                if key_to_delete not in lines:
-                    print(f"[GITHUB] ℹ️  Key not found in {file_path}")
-                    continue
-                
-                new_lines = [line for line in lines if line != key_to_delete]
-                new_content = '\n'.join(new_lines)
-                if new_lines:
-                    new_content += '\n'
-                
-                if self._write_file_content(
-                    file_path,
-                    new_content,
-                    f'Remove key via API'
-                ):
-                    removed_from.append(file_path)
-                    print(f"[GITHUB] ✅ Removed key from {file_path}")
-                else:
-                    print(f"[GITHUB] ⚠️  Failed to update {file_path}")
-                    
-            except Exception as e:
-                print(f"[GITHUB] ⚠️  Exception processing {file_path}: {e}")
+        with self._locked(solved_file_path, *key_files):
+            return self._delete_key_and_save_solved_locked(
+                key_to_delete, key_files, solved_file_path,
+                email, uid, period, prices, coupon_used, coupon_code, discount
+            )
+    
+    def _delete_key_and_save_solved_locked(self, key_to_delete, key_files, solved_file_path,
+                                           email, uid, period, prices, coupon_used, coupon_code, discount):
+        """Body of delete_key_and_save_solved (caller holds the file locks)"""
+        # Read all files concurrently, then commit every change together
+        solved_future = GITHUB_EXECUTOR.submit(self._read_file_content, solved_file_path)
+        results = list(GITHUB_EXECUTOR.map(lambda path: self._process_one_file(path, key_to_delete), key_files))
+        current_content = solved_future.result()
+        changes = {path: content for path, content in zip(key_files, results) if content is not None}
+        
+        # Never replace the sales history with a fresh array: if the current
+        # file can't be read or isn't a JSON array, commit nothing
+        if current_content is None:
+            print(f"[GITHUB] ❌ Could not read {solved_file_path}, not committing")
+            return False
+        try:
+            solved_keys = json.loads(current_content) if current_content.strip() else []
+        except ValueError as e:
+            print(f"[GITHUB] ❌ {solved_file_path} is not valid JSON ({e}), not committing")
+            return False
+        if not isinstance(solved_keys, list):
+            print(f"[GITHUB] ❌ {solved_file_path} is not a JSON array, not committing")
+            return False
         
         # Save to keys_solved.json with full information
         try:
-            solved_file_path = 'data/keys/keys_solved.json'
-            current_content = self._read_file_content(solved_file_path)
-            
-            solved_keys = []
-            if current_content:
-                try:
-                    solved_keys = json.loads(current_content)
-                except:
-                    solved_keys = []
-            
             timestamp = datetime.now().isoformat()
             new_entry = {
                 "key": key_to_delete,
@@ -239,19 +500,23 @@ class GitHubDataManager:
             }
             
             solved_keys.append(new_entry)
-            new_content = json.dumps(solved_keys, indent=2, ensure_ascii=False)
-            
-            if self._write_file_content(
-                solved_file_path,
-                new_content,
-                f'Add solved key via API'
-            ):
-                print(f"[GITHUB] ✅ Saved key to {solved_file_path}")
-            else:
-                print(f"[GITHUB] ⚠️  Failed to update {solved_file_path}")
-                
+            changes[solved_file_path] = json.dumps(solved_keys, indent=2, ensure_ascii=False)
         except Exception as e:
-            print(f"[GITHUB] ⚠️  Exception saving to solved file: {e}")
+            print(f"[GITHUB] ⚠️  Exception building solved file: {e}")
+        
+        if self._batch_commit(changes, 'Remove key and add solved key via API'):
+            removed_from = [path for path in key_files if path in changes]
+        else:
+            # Fall back to one Contents API commit per file
+            print("[GITHUB] ⚠️  Batch commit failed, writing files one by one...")
+            removed_from = []
+            for path, content in changes.items():
+                message = 'Add solved key via API' if path == solved_file_path else 'Remove key via API'
+                if self._write_file_content(path, content, message):
+                    if path != solved_file_path:
+                        removed_from.append(path)
+                else:
+                    print(f"[GITHUB] ⚠️  Failed to update {path}")
         
         if removed_from:
             print(f"[GITHUB] ✅ Successfully processed key across {len(removed_from)} file(s)")
@@ -265,32 +530,26 @@ class GitHubDataManager:
         if not self.use_github:
             return False
         
-        file_map = {
-            '1d': 'data/keys/key1d.txt',
-            '7d': 'data/keys/key7d.txt',
-            '30d': 'data/keys/key30d.txt',
-            '90d': 'data/keys/key90d.txt',
-        }
-        
-        if period not in file_map:
+        if period not in self._FILE_MAP:
             print(f"[GITHUB] ❌ Invalid period: {period}")
             return False
         
         try:
-            file_path = file_map[period]
-            content = self._read_file_content(file_path)
-            
-            if content is None:
-                print(f"[GITHUB] ⚠️  Could not read {file_path}")
-                return False
-            
-            new_content = (content + key_value + '\n') if content else (key_value + '\n')
-            
-            return self._write_file_content(
-                file_path,
-                new_content,
-                f'Add {period} key via API'
-            )
+            file_path = self._FILE_MAP[period]
+            with self._locked(file_path):
+                content = self._read_file_content(file_path)
+                
+                if content is None:
+                    print(f"[GITHUB] ⚠️  Could not read {file_path}")
+                    return False
+                
+                new_content = (content + key_value + '\n') if content else (key_value + '\n')
+                
+                return self._write_file_content(
+                    file_path,
+                    new_content,
+                    f'Add {period} key via API'
+                )
         except Exception as e:
             print(f"[GITHUB] ❌ Exception adding key: {e}")
             return False
@@ -300,18 +559,11 @@ class GitHubDataManager:
         if not self.use_github:
             return []
         
-        file_map = {
-            '1d': 'data/keys/key1d.txt',
-            '7d': 'data/keys/key7d.txt',
-            '30d': 'data/keys/key30d.txt',
-            '90d': 'data/keys/key90d.txt',
-        }
-        
-        if period not in file_map:
+        if period not in self._FILE_MAP:
             return []
         
         try:
-            content = self._read_file_content(file_map[period])
+            content = self._read_file_content(self._FILE_MAP[period])
             if content:
                 return [line.strip() for line in content.split('\n') if line.strip()]
             return []
@@ -338,14 +590,57 @@ app.config['SESSION_COOKIE_SECURE'] = False  # Set to True in production with HT
 app.config['SESSION_COOKIE_HTTPONLY'] = True
 app.config['SESSION_COOKIE_SAMESITE'] = 'Lax'
 
+# Verbose per-step tracing goes through logger.debug; enable with LOG_LEVEL=DEBUG
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO").upper(), format="%(message)s")
+logger = logging.getLogger("app")
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DB_FILE = "orders.db"
 AUTH_FILE = "data/dashboard/auth.json"
 
 SENDGRID_API_KEY = os.environ.get("SENDGRID_API_KEY", "")
 FROM_EMAIL = os.environ.get("FROM_EMAIL", "noreply@muakey.cloud")
+# One SendGrid client for the process instead of one per email
+SENDGRID_CLIENT = SendGridAPIClient(SENDGRID_API_KEY)
+
+# Outbound mail runs on a small worker pool so SendGrid latency doesn't hold
+# request threads; MAIL_RATE_PER_SEC is shared by all workers
+MAIL_EXECUTOR = ThreadPoolExecutor(max_workers=4, thread_name_prefix="mail")
+MAIL_RATE_PER_SEC = 10
+MAIL_RESULT_TIMEOUT = 10
+# SendGrid 429/5xx and connection errors are retried with exponential backoff
+MAIL_SEND_RETRIES = 3
+MAIL_RETRY_BASE_DELAY = 0.5
+# Post-send bookkeeping (Discord logs, key file, order row) for delivered keys
+DELIVERY_EXECUTOR = ThreadPoolExecutor(max_workers=8, thread_name_prefix="delivery")
 
 MB_API_URL = os.environ.get("MB_API_URL", "")
 
+# Shared keep-alive session for the MBBank history API, so payment polling
+# reuses the pooled TLS connection instead of handshaking on every check
+MB_SESSION = requests.Session()
+MB_SESSION.headers.update({
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64)",
+    "Accept": "application/json, text/plain, */*",
+    "Connection": "keep-alive"
+})
+_mb_adapter = HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=20,
+    max_retries=Retry(total=2, backoff_factor=0.3, status_forcelist=[502, 503, 504])
+)
+# MB_API_URL comes from the environment and may be plain http
+MB_SESSION.mount("https://", _mb_adapter)
+MB_SESSION.mount("http://", _mb_adapter)
+_mb_prepared = None
+
+def mb_prepared_request():
+    """The MB history GET, prepared once (URL parsing + header merge) and reused by every poll"""
+    global _mb_prepared
+    if _mb_prepared is None:
+        _mb_prepared = MB_SESSION.prepare_request(requests.Request("GET", MB_API_URL))
+    return _mb_prepared
+
 # Tạo folder data/keys nếu chưa tồn tại
 os.makedirs("data/keys", exist_ok=True)
 
@@ -414,11 +709,17 @@ def initialize_key_files():
             source_path = f"/app/initial_data/{key_type}.txt"
             if os.path.exists(source_path):
                 try:
-                    with open(source_path, "r", encoding="utf-8") as f:
-                        content = f.read()
                     os.makedirs(os.path.dirname(dest_path), exist_ok=True)
-                    with open(dest_path, "w", encoding="utf-8") as f:
-                        f.write(content)
+                    # Same lock + atomic replace as every other key file writer
+                    with key_file_lock(dest_path):
+                        if os.path.exists(dest_path) and os.path.getsize(dest_path) > 0:
+                            continue
+                        tmp = tempfile.NamedTemporaryFile(
+                            "wb", dir=os.path.dirname(dest_path), prefix=".", suffix=".tmp", delete=False
+                        )
+                        with tmp, open(source_path, "rb") as src:
+                            shutil.copyfileobj(src, tmp)
+                        os.replace(tmp.name, dest_path)
                     print(f"[INIT] Restored {key_type} from image")
                 except Exception as e:
                     print(f"[INIT] Failed to restore {key_type}: {e}")
@@ -440,15 +741,108 @@ def initialize_key_files():
                 print(f"[INIT] Failed to restore prices.json: {e}")
 
 # Lock for file operations to prevent race conditions
+# (writers only: key file readers rely on atomic replaces instead)
 file_locks = {}
 lock_manager = Lock()
 
 def get_file_lock(file_path):
     """Lấy lock cho một file (thread-safe)"""
+    # dict.get is atomic; only take lock_manager the first time a path is seen
+    lock = file_locks.get(file_path)
+    if lock is None:
+        with lock_manager:
+            lock = file_locks.setdefault(file_path, Lock())
+    return lock
+
+@contextmanager
+def key_file_lock(file_path):
+    """
+    Exclusive lock for rewriting a key file: the per-file thread lock plus
+    an flock on a sidecar .lock file (so it still holds across os.replace)
+    """
+    with get_file_lock(file_path), open(file_path + ".lock", "a") as lock_file:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        yield
+
+# Parsed JSON config files: {path: (mtime_ns, size, data)}
+_json_file_cache = {}
+# Read-mostly config (prices, admin emails) skips even the stat for this many
+# seconds; our own writes invalidate at once, edits by other processes show up
+# within the TTL
+CONFIG_CACHE_TTL = float(os.environ.get("CONFIG_CACHE_TTL", "2"))
+
+def load_json_cached(path, ttl=0):
+    """
+    json.load a config file, reusing the parsed value while its mtime/size are unchanged
+    
+    With ttl > 0 the mtime/size check itself is skipped for ttl seconds after the last one.
+    Returns a shallow copy so callers can edit top-level fields before saving.
+    Raises FileNotFoundError / ValueError like open + json.load
+    """
+    return load_json_cached_with_etag(path, ttl)[0]
+
+def load_json_cached_with_etag(path, ttl=0):
+    """
+    load_json_cached plus an ETag for exactly the data returned
+    
+    The ETag comes from the mtime/size stamp the data was parsed at (same format
+    as _file_etag), so it can't run ahead of a body still served from the TTL window
+    """
+    now = time.monotonic()
     with lock_manager:
-        if file_path not in file_locks:
-            file_locks[file_path] = Lock()
-        return file_locks[file_path]
+        cached = _json_file_cache.get(path)
+    if cached and ttl and now - cached[3] < ttl:
+        mtime_ns, size, data = cached[:3]
+    else:
+        st = os.stat(path)
+        mtime_ns, size = st.st_mtime_ns, st.st_size
+        if cached and cached[0] == mtime_ns and cached[1] == size:
+            data = cached[2]
+        elif orjson:
+            with open(path, "rb") as f:
+                data = orjson.loads(f.read())
+        else:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        with lock_manager:
+            _json_file_cache[path] = (mtime_ns, size, data, now)
+    return (dict(data) if isinstance(data, dict) else data), f"{mtime_ns:x}-{size:x}"
+
+def invalidate_json_cache(path):
+    """Forget the cached copy of path (call after writing it)"""
+    with lock_manager:
+        _json_file_cache.pop(path, None)
+
+def write_file_atomic(path, data):
+    """
+    Replace path with data (bytes) via a fsynced temp file + os.replace, so
+    readers and a crash mid-write only ever see the old or the new content
+    """
+    tmp = tempfile.NamedTemporaryFile(
+        "wb", dir=os.path.dirname(path) or ".", prefix=".", suffix=".tmp", delete=False
+    )
+    try:
+        with tmp:
+            tmp.write(data)
+            tmp.flush()
+            os.fsync(tmp.fileno())
+        if os.path.exists(path):
+            shutil.copymode(path, tmp.name)
+        os.replace(tmp.name, path)
+    except BaseException:
+        if os.path.exists(tmp.name):
+            os.unlink(tmp.name)
+        raise
+
+def dump_json_file(path, data):
+    """Atomically write data as indented UTF-8 JSON (orjson when available) and drop its cached copy"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if orjson:
+        payload = orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+    else:
+        payload = json.dumps(data, indent=2, ensure_ascii=False).encode("utf-8")
+    write_file_atomic(path, payload)
+    invalidate_json_cache(path)
 
 # =================== Coupon Management (Local) ===================
 COUPON_FILE = "data/coupon/coupons.json"
@@ -456,14 +850,16 @@ COUPON_FILE = "data/coupon/coupons.json"
 def load_coupons():
     """Load coupons from JSON file"""
     try:
-        os.makedirs(os.path.dirname(COUPON_FILE), exist_ok=True)
         if not os.path.exists(COUPON_FILE):
+            os.makedirs(os.path.dirname(COUPON_FILE), exist_ok=True)
             with open(COUPON_FILE, 'w', encoding='utf-8') as f:
                 json.dump({}, f)
             return {}
         
-        with open(COUPON_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
+        # Callers edit coupons in place before save_coupons, so copy each entry
+        coupons = load_json_cached(COUPON_FILE)
+        return {code: dict(coupon) if isinstance(coupon, dict) else coupon
+                for code, coupon in coupons.items()}
     except Exception as e:
         print(f"[COUPON ERROR] Failed to load coupons: {e}")
         return {}
@@ -471,9 +867,8 @@ def load_coupons():
 def save_coupons(coupons):
     """Save coupons to JSON file"""
     try:
-        os.makedirs(os.path.dirname(COUPON_FILE), exist_ok=True)
-        with open(COUPON_FILE, 'w', encoding='utf-8') as f:
-            json.dump(coupons, f, indent=2, ensure_ascii=False)
+        dump_json_file(COUPON_FILE, coupons)
+        invalidate_dashboard_cache()
         return True
     except Exception as e:
         print(f"[COUPON ERROR] Failed to save coupons: {e}")
@@ -514,19 +909,23 @@ def is_coupon_valid(code, period):
 
 def use_coupon(code):
     """Use a coupon (decrease uses_left)"""
-    coupons = load_coupons()
     code = code.upper()
     
-    if code not in coupons:
-        return False
-    
-    coupon = coupons[code]
-    
-    # Only decrease for limited coupons
-    if coupon.get('type') == 'limited':
-        coupon['uses_left'] = max(0, coupon.get('uses_left', 0) - 1)
-        coupons[code] = coupon
-        save_coupons(coupons)
+    # Concurrent redemptions (and admin edits) serialize on the coupon file lock,
+    # so no decrement is lost between load and save
+    with key_file_lock(COUPON_FILE):
+        coupons = load_coupons()
+        
+        if code not in coupons:
+            return False
+        
+        coupon = coupons[code]
+        
+        # Only decrease for limited coupons
+        if coupon.get('type') == 'limited':
+            coupon['uses_left'] = max(0, coupon.get('uses_left', 0) - 1)
+            coupons[code] = coupon
+            save_coupons(coupons)
     
     return True
 
@@ -535,12 +934,9 @@ def get_keys_by_type(period):
     file_path = get_key_file_path(period)
     
     try:
-        if not os.path.exists(file_path):
-            return []
-        
-        with open(file_path, 'r', encoding='utf-8') as f:
-            lines = [line.strip() for line in f.readlines() if line.strip()]
-        return lines
+        return list(load_key_list(file_path))
+    except FileNotFoundError:
+        return []
     except Exception as e:
         print(f"[KEY ERROR] Failed to get keys: {e}")
         return []
@@ -550,109 +946,284 @@ def delete_key(key, admin_email):
     return delete_key_from_file(key, admin_email)
 
 # =================== DB ===================
+class SQLiteConnectionPool:
+    """
+    Pool of reusable SQLite connections so request handlers don't pay
+    sqlite3_open + journal setup on every query
+    
+    Up to max_size idle connections are kept; extra concurrent borrowers get a
+    fresh connection that is closed when returned
+    """
+    
+    def __init__(self, db_file, min_size=2, max_size=8):
+        self.db_file = db_file
+        self.min_size = min_size
+        self._idle = queue.Queue(maxsize=max_size)
+    
+    def _connect(self):
+        """Open a new pooled SQLite connection (autocommit, WAL)"""
+        # Pooled connections live for the whole process, so sqlite3's per-connection
+        # statement cache keeps every helper's SQL prepared; size it above the
+        # number of distinct statements in this module
+        conn = sqlite3.connect(self.db_file, check_same_thread=False, isolation_level=None,
+                               cached_statements=256)
+        conn.row_factory = sqlite3.Row
+        # WAL: dashboard/status readers never block mark_paid and order writes
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA wal_autocheckpoint=1000")
+        conn.execute("PRAGMA busy_timeout=5000")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA cache_size=-20000")
+        conn.execute("PRAGMA mmap_size=268435456")
+        conn.execute("PRAGMA journal_size_limit=67108864")
+        return conn
+    
+    def warm(self):
+        """Open min_size connections up front so the first requests don't"""
+        while self._idle.qsize() < self.min_size and not self._idle.full():
+            self._idle.put_nowait(self._connect())
+    
+    @contextmanager
+    def connection(self):
+        """Borrow a connection and return it to the pool afterwards"""
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            conn = self._connect()
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            try:
+                self._idle.put_nowait(conn)
+            except queue.Full:
+                conn.close()
+
+DB_POOL = SQLiteConnectionPool(DB_FILE, min_size=2, max_size=8)
+
+@contextmanager
+def db_conn(conn=None):
+    """Borrow a connection from DB_POOL
+    
+    If conn is given (e.g. inside complete_order's transaction) it is used as-is
+    """
+    if conn is not None:
+        yield conn
+        return
+    with DB_POOL.connection() as conn:
+        yield conn
+
 def create_db():
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS orders (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            uid TEXT UNIQUE,
-            email TEXT,
-            key TEXT,
-            verification_code TEXT,
-            promo_code TEXT,
-            paid INTEGER DEFAULT 0,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS promo_codes (
-            code TEXT PRIMARY KEY,
-            discount INTEGER,
-            uses_left INTEGER,
-            expires_at TIMESTAMP
-        )
-    ''')
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS key_delivery_log (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            uid TEXT,
-            email TEXT,
-            key TEXT,
-            period TEXT,
-            status TEXT,
-            sent_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    conn.commit()
-    conn.close()
+    with db_conn() as conn:
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS orders (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                uid TEXT UNIQUE,
+                email TEXT,
+                key TEXT,
+                verification_code TEXT,
+                promo_code TEXT,
+                paid INTEGER DEFAULT 0,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS promo_codes (
+                code TEXT PRIMARY KEY COLLATE NOCASE,
+                discount INTEGER,
+                uses_left INTEGER,
+                expires_at TIMESTAMP
+            )
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS key_delivery_log (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                uid TEXT,
+                email TEXT,
+                key TEXT,
+                period TEXT,
+                status TEXT,
+                sent_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        # Older databases have a case-sensitive promo_codes.code key
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_promo_codes_code_nocase ON promo_codes(code COLLATE NOCASE)")
+        # Admin order filters / pending cleanup (paid = ? AND created_at < ?), and
+        # order lookup by transaction code. The compound index also serves plain
+        # paid filters, so the old single-column one is dropped
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_orders_paid_created ON orders(paid, created_at DESC)")
+        conn.execute("DROP INDEX IF EXISTS idx_orders_paid")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_orders_verification_code ON orders(verification_code)")
+        # Newest-first order listings, debug key lookups and the delivery log tail
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_orders_created_at ON orders(created_at DESC)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_delivery_key ON key_delivery_log(key)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_delivery_sent_at ON key_delivery_log(sent_at DESC)")
+        
+        # Row counts kept by triggers, since COUNT(*) has to walk the whole table
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS table_counts (
+                name TEXT PRIMARY KEY,
+                n INTEGER NOT NULL
+            )
+        ''')
+        conn.execute("INSERT OR IGNORE INTO table_counts(name, n) SELECT 'orders', COUNT(*) FROM orders")
+        conn.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_orders_count_insert AFTER INSERT ON orders
+            BEGIN
+                UPDATE table_counts SET n = n + 1 WHERE name = 'orders';
+            END
+        ''')
+        conn.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_orders_count_delete AFTER DELETE ON orders
+            BEGIN
+                UPDATE table_counts SET n = n - 1 WHERE name = 'orders';
+            END
+        ''')
+        conn.execute("COMMIT")
+        
+        # expires_at as epoch seconds (local wall clock, like expires_at), kept in sync by triggers
+        promo_columns = [row["name"] for row in conn.execute("PRAGMA table_info(promo_codes)")]
+        if "expires_at_ts" not in promo_columns:
+            conn.execute("ALTER TABLE promo_codes ADD COLUMN expires_at_ts INTEGER")
+            conn.execute("UPDATE promo_codes SET expires_at_ts = CAST(strftime('%s', expires_at) AS INTEGER) WHERE expires_at IS NOT NULL")
+        conn.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_promo_codes_expires_insert AFTER INSERT ON promo_codes
+            BEGIN
+                UPDATE promo_codes SET expires_at_ts = CAST(strftime('%s', NEW.expires_at) AS INTEGER) WHERE rowid = NEW.rowid;
+            END
+        ''')
+        conn.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_promo_codes_expires_update AFTER UPDATE OF expires_at ON promo_codes
+            BEGIN
+                UPDATE promo_codes SET expires_at_ts = CAST(strftime('%s', NEW.expires_at) AS INTEGER) WHERE rowid = NEW.rowid;
+            END
+        ''')
+
+    DB_POOL.warm()
+
+INSERT_ORDER_SQL = "INSERT OR IGNORE INTO orders (uid, verification_code) VALUES (?, ?)"
+LOG_DELIVERY_SQL = """
+    INSERT INTO key_delivery_log (uid, email, key, period, status)
+    VALUES (?, ?, ?, ?, ?)
+"""
 
 def insert_order(uid, verification_code):
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("INSERT OR IGNORE INTO orders (uid, verification_code) VALUES (?, ?)", (uid, verification_code))
-    conn.commit()
-    conn.close()
-
-def mark_paid(uid):
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("UPDATE orders SET paid=1 WHERE uid=?", (uid,))
-    conn.commit()
-    conn.close()
+    with db_conn() as conn:
+        conn.execute(INSERT_ORDER_SQL, (uid, verification_code))
+
+def insert_orders(rows):
+    """Insert many (uid, verification_code) rows in one transaction"""
+    with db_conn() as conn:
+        conn.execute("BEGIN")
+        conn.executemany(INSERT_ORDER_SQL, rows)
+        conn.execute("COMMIT")
+
+def mark_paid(uid, conn=None):
+    with db_conn(conn) as conn:
+        conn.execute("UPDATE orders SET paid=1 WHERE uid=?", (uid,))
 
 def get_order(uid):
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("SELECT * FROM orders WHERE uid=?", (uid,))
-    row = c.fetchone()
-    conn.close()
-    return row
+    with db_conn() as conn:
+        return conn.execute("SELECT * FROM orders WHERE uid=?", (uid,)).fetchone()
+
+def set_email_key(uid, email, key, promo_code=None, conn=None):
+    with db_conn(conn) as conn:
+        conn.execute("UPDATE orders SET email=?, key=?, promo_code=? WHERE uid=?",
+                     (email, key, promo_code, uid))
+
+# Legacy promo rows by upper-cased code: {code: (fetched_at, row)}
+PROMO_CACHE_TTL = 60
+PROMO_CACHE_MAX = 512
+_promo_cache = {}
+_promo_cache_lock = Lock()
 
-def set_email_key(uid, email, key, promo_code=None):
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("UPDATE orders SET email=?, key=?, promo_code=? WHERE uid=?",
-              (email, key, promo_code, uid))
-    conn.commit()
-    conn.close()
+def _local_epoch():
+    """Current local wall-clock time as epoch seconds (matches expires_at_ts)"""
+    return calendar.timegm(time.localtime())
+
+def _get_promo_row(code):
+    """
+    promo_codes row for code (None if missing), cached for PROMO_CACHE_TTL seconds
+    
+    Misses are not cached, so a newly added code works on the next lookup
+    """
+    cache_key = code.upper()
+    now = time.monotonic()
+    with _promo_cache_lock:
+        cached = _promo_cache.get(cache_key)
+    if cached and now - cached[0] < PROMO_CACHE_TTL:
+        return cached[1]
+    
+    with db_conn() as conn:
+        row = conn.execute("""
+            SELECT code, discount, uses_left, expires_at, expires_at_ts FROM promo_codes
+            WHERE code=? COLLATE NOCASE AND uses_left != 0
+              AND (expires_at_ts IS NULL OR expires_at_ts >= ?)
+        """, (code, _local_epoch())).fetchone()
+    if row is None:
+        return None
+    with _promo_cache_lock:
+        if len(_promo_cache) >= PROMO_CACHE_MAX:
+            _promo_cache.clear()
+        _promo_cache[cache_key] = (now, row)
+    return row
 
 def get_promo(code):
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("SELECT * FROM promo_codes WHERE code=?", (code.upper(),))
-    row = c.fetchone()
-    conn.close()
+    row = _get_promo_row(code)
     if not row:
         return None
-    if row[3] and datetime.now() > datetime.strptime(row[3], "%Y-%m-%d %H:%M:%S"):
+    # Rows can sit in the cache past their expiry, so re-check it here
+    if row["expires_at_ts"] is not None and _local_epoch() > row["expires_at_ts"]:
         return None
-    if row[2] == 0:
-        return None
-    return {"code": row[0], "discount": row[1], "uses_left": row[2], "expires_at": row[3]}
-
-def decrement_promo(code):
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("UPDATE promo_codes SET uses_left=uses_left-1 WHERE code=?", (code.upper(),))
-    conn.commit()
-    conn.close()
+    return {"code": row["code"], "discount": row["discount"], "uses_left": row["uses_left"], "expires_at": row["expires_at"]}
+
+def decrement_promo(code, conn=None):
+    """Use up one redemption of the promo row whose stored code is exactly code (as get_promo returns it)"""
+    with db_conn(conn) as conn:
+        # No COLLATE NOCASE: on legacy case-sensitive tables "abc" and "ABC" are separate rows
+        conn.execute("UPDATE promo_codes SET uses_left=uses_left-1 WHERE code=?", (code,))
+    with _promo_cache_lock:
+        _promo_cache.pop(code.upper(), None)
+
+def complete_order(uid, email, key, promo_code=None, use_promo=False):
+    """Record the delivered key, mark the order paid and consume the legacy promo in one transaction"""
+    with db_conn() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            set_email_key(uid, email, key, promo_code, conn=conn)
+            mark_paid(uid, conn=conn)
+            if use_promo and promo_code:
+                decrement_promo(promo_code, conn=conn)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.rollback()
+            raise
 
 def log_key_delivery(uid, email, key, period, status="sent"):
     """Ghi lại lần gửi key để tracking"""
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("""
-        INSERT INTO key_delivery_log (uid, email, key, period, status)
-        VALUES (?, ?, ?, ?, ?)
-    """, (uid, email, key, period, status))
-    conn.commit()
-    conn.close()
-    print(f"[TRACKING] Logged delivery: UID={uid}, Email={email}, Key={key}, Period={period}, Status={status}")
+    with db_conn() as conn:
+        conn.execute(LOG_DELIVERY_SQL, (uid, email, key, period, status))
+    logger.debug("[TRACKING] Logged delivery: UID=%s, Email=%s, Key=%s, Period=%s, Status=%s",
+                 uid, email, key, period, status)
+
+def log_key_deliveries(rows):
+    """Log many (uid, email, key, period, status) deliveries in one transaction"""
+    with db_conn() as conn:
+        conn.execute("BEGIN")
+        conn.executemany(LOG_DELIVERY_SQL, rows)
+        conn.execute("COMMIT")
+    logger.debug("[TRACKING] Logged %d deliveries", len(rows))
 
 # =================== Prices Management ===================
 def load_prices():
     """Load prices from JSON file"""
+    return load_prices_with_etag()[0]
+
+def load_prices_with_etag():
+    """(prices, ETag of the prices.json they came from), ETag None for the defaults"""
     price_file = os.path.join("data", "prices", "prices.json")
     
     # Default prices if file doesn't exist
@@ -664,23 +1235,21 @@ def load_prices():
     }
     
     try:
-        if os.path.exists(price_file):
-            with open(price_file, "r", encoding="utf-8") as f:
-                prices = json.load(f)
-                return prices if prices else default_prices
-        return default_prices
+        prices, etag = load_json_cached_with_etag(price_file, ttl=CONFIG_CACHE_TTL)
+        return (prices, etag) if prices else (default_prices, None)
+    except FileNotFoundError:
+        return default_prices, None
     except Exception as e:
         print(f"[PRICES ERROR] Failed to load prices: {e}")
-        return default_prices
+        return default_prices, None
 
 def save_prices(prices):
     """Save prices to JSON file"""
     price_file = os.path.join("data", "prices", "prices.json")
     
     try:
-        os.makedirs(os.path.dirname(price_file), exist_ok=True)
-        with open(price_file, "w", encoding="utf-8") as f:
-            json.dump(prices, f, indent=4, ensure_ascii=False)
+        dump_json_file(price_file, prices)
+        invalidate_dashboard_cache()
         print(f"[PRICES] Saved prices to {price_file}")
         return True
     except Exception as e:
@@ -693,69 +1262,382 @@ def get_price(period_code):
     return prices.get(period_code, {}).get("amount", 0)
 
 # =================== Utils ===================
+# Period code <-> period name used in emails/logs, and its display label
+CODE_TO_PERIOD = {"1d": "1 day", "7d": "7 day", "30d": "30 day", "90d": "90 day"}
+PERIOD_TO_CODE = {v: k for k, v in CODE_TO_PERIOD.items()}
+PERIOD_DISPLAY = {
+    "1 day": "1 Ngày",
+    "7 day": "1 Tuần",
+    "30 day": "1 Tháng",
+    "90 day": "1 Mùa"
+}
+# Key stock files per period code
+KEYS_DIR = os.path.join("data", "keys")
+KEY_FILE_NAMES = {p: f"key{p}.txt" for p in CODE_TO_PERIOD}
+PERIOD_FILES = {p: os.path.join(KEYS_DIR, name) for p, name in KEY_FILE_NAMES.items()}
+VALID_PERIODS = frozenset(PERIOD_FILES)
+# Locks for the files we write are created up front; get_file_lock only
+# falls back to lock_manager for a path outside this fixed set
+for _path in (*PERIOD_FILES.values(), COUPON_FILE):
+    file_locks.setdefault(_path, Lock())
+del _path
+
 def get_key_file_path(period_code):
     """Get correct key file path"""
     base_period = period_code.replace("_v2", "")
-    file_path = os.path.join("data", "keys", f"key{base_period}.txt")
+    file_path = PERIOD_FILES.get(base_period)
+    if file_path is None:
+        file_path = os.path.join(KEYS_DIR, f"key{base_period}.txt")
     return file_path
 
+def _byte_table(chars):
+    """Build a bytes.translate table mapping random bytes onto chars uniformly"""
+    usable = 256 - 256 % len(chars)
+    table = bytes(ord(chars[b % len(chars)]) if b < usable else 0 for b in range(256))
+    return table, bytes(range(usable, 256))
+
+def _random_string(table_and_reject, length):
+    """Draw length chars from secrets.token_bytes via a _byte_table (rejection sampled)"""
+    table, reject = table_and_reject
+    out = b""
+    while len(out) < length:
+        out += secrets.token_bytes(length + 4).translate(table, reject)
+    return out[:length].decode("ascii")
+
+UID_CHARS = _byte_table(string.ascii_uppercase + string.digits)
+# Loại bỏ O (nhầm với 0), I (nhầm với 1), l (nhầm với 1)
+VERIFICATION_CHARS = _byte_table('ABCDEFGHJKLMNPQRSTUVWXYZ23456789')  # Không có O, I; không có 0, 1
+
 def generate_uid(length=6):
-    return ''.join(random.choices(string.ascii_uppercase + string.digits, k=length))
+    return _random_string(UID_CHARS, length)
 
 def generate_verification_code(length=5):
-    # Loại bỏ O (nhầm với 0), I (nhầm với 1), l (nhầm với 1)
-    chars = 'ABCDEFGHJKLMNPQRSTUVWXYZ23456789'  # Không có O, I; không có 0, 1
-    return ''.join(random.choices(chars, k=length))
+    return _random_string(VERIFICATION_CHARS, length)
+
+# In-memory key lists: {file_path: (mtime_ns, size, keys)}
+# The files stay authoritative (admin, bot and GitHub sync also write them),
+# so a list is only reused while the file's mtime and size are unchanged
+_key_list_cache = {}
+
+def load_key_list(file_path):
+    """
+    Get the non-empty, stripped keys in file_path as a tuple
+    
+    Needs no lock: key files are only ever swapped in whole with os.replace,
+    so a read sees either the old or the new file. Raises FileNotFoundError
+    if the file does not exist
+    """
+    st = os.stat(file_path)
+    cached = _key_list_cache.get(file_path)
+    if cached and cached[0] == st.st_mtime_ns and cached[1] == st.st_size:
+        return cached[2]
+    
+    # One read + C-level split; blank lines are dropped before decoding
+    with open(file_path, "rb") as f:
+        keys = tuple(k.decode("utf-8") for k in map(bytes.strip, f.read().splitlines()) if k)
+    _key_list_cache[file_path] = (st.st_mtime_ns, st.st_size, keys)
+    return keys
+
+# {file_path: (keys tuple it was built from, frozenset of those keys)}
+_key_set_cache = {}
+
+def load_key_set(file_path):
+    """Keys in file_path as a frozenset for O(1) membership, rebuilt only when load_key_list changes"""
+    keys = load_key_list(file_path)
+    cached = _key_set_cache.get(file_path)
+    if cached and cached[0] is keys:
+        return cached[1]
+    key_set = frozenset(keys)
+    _key_set_cache[file_path] = (keys, key_set)
+    return key_set
+
+def existing_key_files(keys_dir=KEYS_DIR):
+    """Names of the files in keys_dir, from one directory scan"""
+    try:
+        with os.scandir(keys_dir) as it:
+            return {entry.name for entry in it if entry.is_file()}
+    except FileNotFoundError:
+        return set()
+
+def read_key_file(period_code, head=10):
+    """Get (count, first `head` keys) for a period from one cached read of its key file"""
+    file_path = get_key_file_path(period_code)
+    
+    try:
+        keys = load_key_list(file_path)
+    except FileNotFoundError:
+        return 0, []
+    except Exception as e:
+        print(f"[KEY ERROR] Failed to read keys in {file_path}: {e}")
+        return 0, []
+    return len(keys), list(keys[:head])
+
+# Landing-page stock counts: {period_code: (checked_at, count)}
+# In-process writers invalidate explicitly; KEY_INDEX_TTL bounds how long a
+# write by another process (bot, GitHub sync) can go unnoticed
+KEY_INDEX_TTL = 2.0
+_KEY_INDEX = {}
+
+def invalidate_key_index(period_code=None):
+    """Drop indexed counts for one period (or all) so the next read re-checks the file"""
+    if period_code is None:
+        _KEY_INDEX.clear()
+    else:
+        _KEY_INDEX.pop(period_code.replace("_v2", ""), None)
+
+def indexed_key_count(period_code):
+    """count_keys, served from memory for up to KEY_INDEX_TTL seconds"""
+    period_code = period_code.replace("_v2", "")
+    entry = _KEY_INDEX.get(period_code)
+    now = time.monotonic()
+    if entry and now - entry[0] < KEY_INDEX_TTL:
+        return entry[1]
+    count = count_keys(period_code)
+    _KEY_INDEX[period_code] = (now, count)
+    return count
 
 def count_keys(period_code):
     """Count remaining keys for a given period code"""
     file_path = get_key_file_path(period_code)
     
-    # Dùng lock để đảm bảo đọc file đúng
-    file_lock = get_file_lock(file_path)
+    # Lock-free: writers replace the file atomically (see load_key_list)
+    try:
+        return len(load_key_list(file_path))
+    except FileNotFoundError:
+        return 0
+    except Exception as e:
+        print(f"[KEY ERROR] Failed to count keys in {file_path}: {e}")
+        return 0
+
+# Admin key additions are queued and appended in batches: a burst of adds
+# becomes one open/write/fsync per file instead of one per key
+KEY_APPEND_INTERVAL = 0.2
+# A failed batch is retried with doubling delays up to this
+KEY_APPEND_MAX_RETRY_DELAY = 30.0
+# How long admin_api_add_key waits for its batch to reach the file
+KEY_APPEND_CONFIRM_TIMEOUT = 5.0
+# {period_code: deque of (key, Event set once the key is on disk)}
+_pending_key_appends = {period: deque() for period in PERIOD_FILES}
+_key_append_wakeup = threading.Event()
+_key_append_thread = None
+_key_append_thread_lock = Lock()
+
+def queue_key_append(period_code, key):
+    """
+    Queue key for appending to the period's key file (written within KEY_APPEND_INTERVAL)
     
-    with file_lock:
-        if not os.path.exists(file_path):
-            return 0
-        
+    Returns an Event that is set once the batch holding the key has been written
+    """
+    global _key_append_thread
+    written = threading.Event()
+    _pending_key_appends[period_code].append((key, written))
+    if _key_append_thread is None:
+        with _key_append_thread_lock:
+            if _key_append_thread is None:
+                _key_append_thread = threading.Thread(target=_key_append_worker, name="key-append", daemon=True)
+                _key_append_thread.start()
+    _key_append_wakeup.set()
+    return written
+
+def append_key_lines(file_path, keys):
+    """
+    Append keys to file_path by writing a temp copy and os.replace-ing it in
+    (caller holds key_file_lock), so lock-free readers never see a torn last line
+    """
+    try:
+        with open(file_path, "rb") as f:
+            existing = f.read()
+    except FileNotFoundError:
+        existing = b""
+    if existing and not existing.endswith(b"\n"):
+        existing += b"\n"
+    write_file_atomic(file_path, existing + "".join(f"{key}\n" for key in keys).encode("utf-8"))
+
+def flush_key_appends():
+    """Write all queued keys to their files, returns False if any batch failed (it stays queued)"""
+    all_written = True
+    for period_code, pending in _pending_key_appends.items():
+        batch = []
+        while pending:
+            batch.append(pending.popleft())
+        if not batch:
+            continue
+        file_path = PERIOD_FILES[period_code]
         try:
-            with open(file_path, "r", encoding="utf-8") as f:
-                lines = [line.strip() for line in f.readlines() if line.strip()]
-            return len(lines)
+            with key_file_lock(file_path):
+                append_key_lines(file_path, [key for key, _ in batch])
         except Exception as e:
-            print(f"[KEY ERROR] Failed to count keys in {file_path}: {e}")
-            return 0
+            print(f"[KEY ERROR] Failed to append {len(batch)} keys to {file_path}: {e}")
+            # Put them back in front so the next flush retries in order
+            pending.extendleft(reversed(batch))
+            all_written = False
+            continue
+        invalidate_key_index(period_code)
+        invalidate_dashboard_cache()
+        for _, written in batch:
+            written.set()
+    return all_written
+
+def _key_append_worker():
+    delay = KEY_APPEND_INTERVAL
+    while True:
+        _key_append_wakeup.wait()
+        # Let a burst of adds pile up before touching the files
+        time.sleep(delay)
+        _key_append_wakeup.clear()
+        if flush_key_appends():
+            delay = KEY_APPEND_INTERVAL
+        else:
+            # Nothing else wakes us for keys already queued: retry them after a backoff
+            delay = min(delay * 2, KEY_APPEND_MAX_RETRY_DELAY)
+            _key_append_wakeup.set()
+
+atexit.register(flush_key_appends)
+
+# Keys handed to an in-flight order but not yet removed from their file;
+# get_key_from_file skips these so two concurrent buyers never get the same key
+reserved_keys = set()
+reserved_keys_lock = Lock()
+
+def release_key(key):
+    """Release a key reserved by get_key_from_file (after it was sold or the send failed)"""
+    if key:
+        with reserved_keys_lock:
+            reserved_keys.discard(key.strip())
 
 def get_key_from_file(period_code):
     # Handle v1 and v2 variants
     file_path = get_key_file_path(period_code)
     
-    # Dùng lock để tránh đọc file khi file đang được ghi
-    file_lock = get_file_lock(file_path)
-    
-    with file_lock:
-        print(f"[KEY DEBUG] Checking file: {file_path}")
-        if not os.path.exists(file_path):
-            print(f"[KEY ERROR] File not found: {file_path}")
+    # Lock-free: writers replace the file atomically (see load_key_list)
+    logger.debug("[KEY DEBUG] Checking file: %s", file_path)
+    try:
+        keys = load_key_list(file_path)
+        if not keys:
+            print("[KEY ERROR] No lines in file")
             return None
         
+        # Usually the first key; skip ones reserved by pending orders
+        with reserved_keys_lock:
+            for key in keys:
+                if key not in reserved_keys:
+                    reserved_keys.add(key)
+                    logger.debug("[KEY DEBUG] Key to send: %s", key)
+                    return key
+        
+        print("[KEY ERROR] All keys in file are reserved by pending orders")
+        return None
+    except FileNotFoundError:
+        print(f"[KEY ERROR] File not found: {file_path}")
+        return None
+    except Exception as e:
+        print(f"[KEY ERROR] Exception: {e}")
+        import traceback
+        traceback.print_exc()
+        return None
+
+def append_solved_entry(solved_file, entry):
+    """
+    Append một entry vào mảng JSON trong keys_solved.json
+    
+    Mảng cũ được chép nguyên bytes (không parse lại) vào file tạm rồi thay
+    bằng write_file_atomic, nên crash giữa chừng không để lại mảng hỏng.
+    Mỗi lần bán vẫn ghi lại cả file (O(kích thước lịch sử)), đổi lấy an toàn.
+    File có sẵn mà không phải mảng JSON thì giữ nguyên và raise ValueError
+    thay vì ghi đè mất lịch sử bán
+    """
+    entry_bytes = json.dumps(entry, indent=2, ensure_ascii=False).replace("\n", "\n  ").encode("utf-8")
+    
+    try:
+        with open(solved_file, "rb") as f:
+            data = f.read().strip()
+    except FileNotFoundError:
+        data = b""
+    
+    if not data:
+        payload = b"[\n  " + entry_bytes + b"\n]"
+    elif data.startswith(b"[") and data.endswith(b"]"):
+        before = data[:-1].rstrip()
+        separator = b"\n  " if before == b"[" else b",\n  "
+        payload = before + separator + entry_bytes + b"\n]"
+    else:
+        logger.error("[SOLVED] %s is not a JSON array, leaving it untouched", solved_file)
+        raise ValueError(f"{solved_file} is not a JSON array")
+    
+    write_file_atomic(solved_file, payload)
+
+def file_contains(file_path, needle):
+    """Check whether file_path contains the bytes needle (mmap + C-level find, no line parsing)"""
+    with open(file_path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return False
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return mm.find(needle) != -1
+
+def remove_key_lines(file_path, key_to_delete):
+    """
+    Stream file_path into a temp file without the lines equal to key_to_delete,
+    then atomically swap it in. Returns how many lines were removed
+    """
+    removed = 0
+    tmp = tempfile.NamedTemporaryFile(
+        "w", encoding="utf-8", dir=os.path.dirname(file_path),
+        prefix=".", suffix=".tmp", delete=False
+    )
+    try:
+        with tmp, open(file_path, "r", encoding="utf-8") as src:
+            for line in src:
+                if line.strip() == key_to_delete:
+                    removed += 1
+                else:
+                    tmp.write(line)
+            # Only a file that will replace the original needs to reach the disk
+            if removed:
+                tmp.flush()
+                os.fsync(tmp.fileno())
+        
+        if removed:
+            shutil.copymode(file_path, tmp.name)
+            os.replace(tmp.name, file_path)
+            invalidate_key_index()
+        else:
+            os.unlink(tmp.name)
+    except BaseException:
+        if os.path.exists(tmp.name):
+            os.unlink(tmp.name)
+        raise
+    return removed
+
+def remove_key_from_local_files(key_to_delete):
+    """Remove key_to_delete from every local key file, returns the names of the files it was in"""
+    removed_from = []
+    key_bytes = key_to_delete.encode("utf-8")
+    
+    for key_file in KEY_FILE_NAMES.values():
+        full_path = os.path.join(KEYS_DIR, key_file)
+        
+        if not os.path.exists(full_path):
+            logger.debug("[DELETE_KEY] ℹ️  File not found: %s", full_path)
+            continue
+        
         try:
-            with open(file_path, "r", encoding="utf-8") as f:
-                lines = f.readlines()
-            
-            print(f"[KEY DEBUG] Lines in file: {len(lines)}")
-            if not lines:
-                print("[KEY ERROR] No lines in file")
-                return None
+            # Thread lock + flock so readers/other processes never see a half-written file
+            with key_file_lock(full_path):
+                # Usually the key lives in just one file: skip the others without rewriting
+                if file_contains(full_path, key_bytes):
+                    removed = remove_key_lines(full_path, key_to_delete)
+                else:
+                    removed = 0
             
-            key = lines[0].strip()
-            print(f"[KEY DEBUG] Key to send: {key}")
-            return key
+            if removed:
+                logger.debug("[DELETE_KEY] ✅ Removed %d occurrence(s) from %s", removed, key_file)
+                removed_from.append(key_file)
+            else:
+                logger.debug("[DELETE_KEY] ℹ️  Key not found in %s", full_path)
+                
         except Exception as e:
-            print(f"[KEY ERROR] Exception: {e}")
-            import traceback
-            traceback.print_exc()
-            return None
+            print(f"[DELETE_KEY] ❌ Error processing {full_path}: {e}")
+    return removed_from
 
 def delete_key_from_file(key_to_delete, email=None, uid=None, period=None, prices=None, coupon_used=False, coupon_code=None, discount=0):
     """
@@ -768,88 +1650,39 @@ def delete_key_from_file(key_to_delete, email=None, uid=None, period=None, price
         return False
     
     key_to_delete = key_to_delete.strip()  # Ensure stripped
-    print(f"[DELETE_KEY] ✅ START: Processing key: [{key_to_delete}]")
+    logger.debug("[DELETE_KEY] ✅ START: Processing key: [%s]", key_to_delete)
     
     # Try GitHub API first (if available)
     github_mgr = get_github_manager()
     if github_mgr.use_github:
-        print("[DELETE_KEY] 🔄 Using GitHub API to update data...")
+        logger.debug("[DELETE_KEY] 🔄 Using GitHub API to update data...")
+        # The manager's own _locked() serializes the remote read-modify-write;
+        # key_file_lock(SOLVED_FILE) is only for writes to the local file
         success = github_mgr.delete_key_and_save_solved(key_to_delete, email, uid, period, prices, coupon_used, coupon_code, discount)
         if success:
-            print("[DELETE_KEY] ✅ GitHub API update successful")
+            logger.debug("[DELETE_KEY] ✅ GitHub API update successful")
+            # get_key_from_file reads the local files: drop the sold key there
+            # too instead of waiting for sync_keys to pull the GitHub copy
+            remove_key_from_local_files(key_to_delete)
             return True
         else:
             print("[DELETE_KEY] ⚠️  GitHub API update failed, continuing with local files...")
     
     # Fallback: Local file operations
-    print("[DELETE_KEY] 📁 Using local file operations...")
+    logger.debug("[DELETE_KEY] 📁 Using local file operations...")
     
-    solved_file = os.path.join("data", "keys", "keys_solved.json")
-    keys_dir = os.path.join("data", "keys")
-    key_files = ["key1d.txt", "key7d.txt", "key30d.txt", "key90d.txt"]
-    
-    removed_from = []
-    key_found = False
+    solved_file = SOLVED_FILE
     
     try:
         # Step 1: Xóa key từ TẤT CẢ các file
-        for key_file in key_files:
-            full_path = os.path.join(keys_dir, key_file)
-            
-            if not os.path.exists(full_path):
-                print(f"[DELETE_KEY] ℹ️  File not found: {full_path}")
-                continue
-            
-            try:
-                # Đọc file
-                with open(full_path, "r", encoding="utf-8") as f:
-                    lines = f.readlines()
-                
-                print(f"[DELETE_KEY] Read {len(lines)} lines from {full_path}")
-                
-                # Tìm key (so sánh sau strip)
-                found_indices = []
-                for i, line in enumerate(lines):
-                    if line.strip() == key_to_delete:
-                        found_indices.append(i)
-                
-                if found_indices:
-                    print(f"[DELETE_KEY] Found at line(s): {found_indices}")
-                    key_found = True
-                    
-                    # Xóa những lines có key
-                    new_lines = [line for i, line in enumerate(lines) if i not in found_indices]
-                    
-                    # Ghi file lại
-                    with open(full_path, "w", encoding="utf-8") as f:
-                        f.writelines(new_lines)
-                        f.flush()
-                        os.fsync(f.fileno())
-                    
-                    print(f"[DELETE_KEY] ✅ Removed {len(found_indices)} occurrence(s) from {key_file}")
-                    removed_from.append(key_file)
-                else:
-                    print(f"[DELETE_KEY] ℹ️  Key not found in {full_path}")
-                    
-            except Exception as e:
-                print(f"[DELETE_KEY] ❌ Error processing {full_path}: {e}")
+        removed_from = remove_key_from_local_files(key_to_delete)
         
         # Step 2: Luôn lưu key vào keys_solved.json
-        print(f"[DELETE_KEY] 💾 Saving key to {solved_file}...")
+        logger.debug("[DELETE_KEY] 💾 Saving key to %s...", solved_file)
         solved_dir = os.path.dirname(solved_file)
         os.makedirs(solved_dir, exist_ok=True)
         
         try:
-            # Load existing data
-            solved_keys = []
-            if os.path.exists(solved_file):
-                try:
-                    with open(solved_file, "r", encoding="utf-8") as f:
-                        solved_keys = json.load(f)
-                except:
-                    solved_keys = []
-            
-            # Add new entry
             timestamp = datetime.now().isoformat()
             new_entry = {
                 "key": key_to_delete,
@@ -862,23 +1695,16 @@ def delete_key_from_file(key_to_delete, email=None, uid=None, period=None, price
                 "couponcode": coupon_code if coupon_code else "N/A",
                 "discount": discount if discount else 0
             }
-            solved_keys.append(new_entry)
-            
-            # Save back
-            with open(solved_file, "w", encoding="utf-8") as f:
-                json.dump(solved_keys, f, indent=2, ensure_ascii=False)
-                f.flush()
-                os.fsync(f.fileno())
-            print(f"[DELETE_KEY] ✅ Successfully saved to {solved_file}")
+            with key_file_lock(solved_file):
+                append_solved_entry(solved_file, new_entry)
+            logger.debug("[DELETE_KEY] ✅ Successfully saved to %s", solved_file)
         except Exception as e:
             print(f"[DELETE_KEY] ❌ Failed to save to {solved_file}: {e}")
             return False
         
         # Summary
         if removed_from:
-            print(f"[DELETE_KEY] ✅ COMPLETED: Removed from {removed_from} and saved to solved file")
-        elif key_found:
-            print(f"[DELETE_KEY] ✅ COMPLETED: Found and saved to solved file")
+            logger.info("[DELETE_KEY] ✅ COMPLETED: Removed from %s and saved to solved file", removed_from)
         else:
             print(f"[DELETE_KEY] ⚠️  Key not found in any file but saved to solved file anyway")
         
@@ -891,84 +1717,191 @@ def delete_key_from_file(key_to_delete, email=None, uid=None, period=None, price
         return False
 
 def generate_key(period):
-    period_map_reverse = {"1 day": "1d", "7 day": "7d", "30 day": "30d", "90 day": "90d"}
-    period_code = period_map_reverse.get(period, "30d")
-    return get_key_from_file(period_code)
-
-def send_key(email, key, uid, period="30 day"):
+    return get_key_from_file(PERIOD_TO_CODE.get(period, "30d"))
+
+# Key email template, read once at import ("\r" stripped up front)
+GMAIL_TEMPLATE_PATH = os.path.join(BASE_DIR, "templates", "gmail.html")
+KEY_INSTALL_LINK = "https://install.muakey.cloud/?auto=1&version=v1&pwd=666CHEATV1-ABC"
+# {{uid}} / {{key}} / {{period}} / {{link}} placeholders
+GMAIL_TEMPLATE_VARS_RE = re.compile(r"\{\{(uid|key|period|link)\}\}")
+
+try:
+    with open(GMAIL_TEMPLATE_PATH, "r", encoding="utf-8") as f:
+        GMAIL_TEMPLATE = f.read().replace("\r", "")
+    # Split once into (literal, name, literal, name, ..., literal): odd slots are
+    # placeholder names, so rendering is a single join with no rescanning
+    GMAIL_TEMPLATE_PARTS = tuple(GMAIL_TEMPLATE_VARS_RE.split(GMAIL_TEMPLATE))
+except FileNotFoundError:
+    GMAIL_TEMPLATE = None
+    GMAIL_TEMPLATE_PARTS = ()
+
+def render_template_parts(parts, values):
+    """Join literal segments with values[name] for each placeholder slot"""
+    rendered = list(parts)
+    for i in range(1, len(rendered), 2):
+        rendered[i] = values[rendered[i]]
+    return "".join(rendered)
+
+def build_key_message(email, key, uid, period="30 day"):
     """
-    Gửi email qua SendGrid API và trả về (ok: bool, err_msg: str)
+    Render the key email (no network), returns (Mail, "") or (None, err_msg)
     """
     try:
-        # tìm template an toàn theo path file này
-        base_dir = os.path.dirname(os.path.abspath(__file__))
-        template_path = os.path.join(base_dir, "templates", "gmail.html")
-
-        if not os.path.exists(template_path):
-            err = f"Template not found: {template_path}"
+        if GMAIL_TEMPLATE is None:
+            err = f"Template not found: {GMAIL_TEMPLATE_PATH}"
             print(f"[EMAIL ERROR] {err}")
-            return False, err
-
-        with open(template_path, "r", encoding="utf-8") as f:
-            html_content = f.read()
+            return None, err
 
         key_for_email = key if key is not None else "N/A"
         
         # Map period để hiển thị
-        period_display_map = {
-            "1 day": "1 Ngày",
-            "7 day": "1 Tuần", 
-            "30 day": "1 Tháng",
-            "90 day": "1 Mùa"
-        }
-        period_display = period_display_map.get(period, period)
+        period_display = PERIOD_DISPLAY.get(period, period)
 
-        # Replace template variables instead of using .format() to avoid issues with CSS braces
+        # Fill the pre-split template; CSS braces are left alone
         try:
-            html_content = html_content.replace("{{uid}}", uid)
-            html_content = html_content.replace("{{key}}", key_for_email)
-            html_content = html_content.replace("{{period}}", period_display)
-            html_content = html_content.replace("{{link}}", "https://install.muakey.cloud/?auto=1&version=v1&pwd=666CHEATV1-ABC")
-            html_content = html_content.replace("\r", "")
+            values = {
+                "uid": uid,
+                "key": key_for_email,
+                "period": period_display,
+                "link": KEY_INSTALL_LINK
+            }
+            html_content = render_template_parts(GMAIL_TEMPLATE_PARTS, values)
         except Exception as e:
             print(f"[EMAIL ERROR] Template replacement error: {e}")
-            return False, f"Template replacement error: {e}"
-
-        # Gửi qua SendGrid
-        try:
-            sg = SendGridAPIClient(SENDGRID_API_KEY)
-            message = Mail(
-                from_email=FROM_EMAIL,
-                to_emails=email,
-                subject="🔑 Key & Mã đơn hàng của bạn đã sẵn sàng!",
-                html_content=html_content
-            )
-            response = sg.send(message)
+            return None, f"Template replacement error: {e}"
 
-            if response.status_code == 202:
-                print(f"[EMAIL SENT] {email} ({uid})")
-                return True, ""
-            else:
-                err = f"SendGrid error: {response.status_code}"
-                print(f"[EMAIL ERROR] {err}")
-                return False, err
-        except Exception as sg_err:
-            print(f"[EMAIL ERROR] SendGrid: {sg_err}")
-            return False, str(sg_err)
+        return Mail(
+            from_email=FROM_EMAIL,
+            to_emails=email,
+            subject="🔑 Key & Mã đơn hàng của bạn đã sẵn sàng!",
+            html_content=html_content
+        ), ""
 
     except Exception as e:
         print(f"[EMAIL ERROR] {e}")
         import traceback
         traceback.print_exc()
-        return False, f"Lỗi gửi email: {e}"
+        return None, f"Lỗi gửi email: {e}"
+
+def deliver_key_message(message, email, uid):
+    """Send a built key email via SendGrid (with retries), returns (ok, err_msg)"""
+    try:
+        response = sendgrid_send(message)
+
+        if response.status_code == 202:
+            print(f"[EMAIL SENT] {email} ({uid})")
+            return True, ""
+        else:
+            err = f"SendGrid error: {response.status_code}"
+            print(f"[EMAIL ERROR] {err}")
+            return False, err
+    except Exception as sg_err:
+        print(f"[EMAIL ERROR] SendGrid: {sg_err}")
+        return False, str(sg_err)
+
+def send_key(email, key, uid, period="30 day"):
+    """
+    Gửi email qua SendGrid API và trả về (ok: bool, err_msg: str)
+    """
+    message, err = build_key_message(email, key, uid, period)
+    if message is None:
+        return False, err
+    return deliver_key_message(message, email, uid)
+
+_mail_bucket = {"tokens": float(MAIL_RATE_PER_SEC), "at": time.monotonic()}
+_mail_bucket_lock = Lock()
+
+def _acquire_mail_token():
+    """Block until the shared mail token bucket allows another send"""
+    while True:
+        with _mail_bucket_lock:
+            now = time.monotonic()
+            tokens = _mail_bucket["tokens"] + (now - _mail_bucket["at"]) * MAIL_RATE_PER_SEC
+            _mail_bucket["tokens"] = min(float(MAIL_RATE_PER_SEC), tokens)
+            _mail_bucket["at"] = now
+            if _mail_bucket["tokens"] >= 1:
+                _mail_bucket["tokens"] -= 1
+                return
+            wait = (1 - _mail_bucket["tokens"]) / MAIL_RATE_PER_SEC
+        time.sleep(wait)
+
+def submit_mail(send_func, *args):
+    """Queue a mail send on MAIL_EXECUTOR (rate limited), returns a Future"""
+    def job():
+        _acquire_mail_token()
+        return send_func(*args)
+    return MAIL_EXECUTOR.submit(job)
+
+def sendgrid_send(message):
+    """SENDGRID_CLIENT.send, retrying 429/5xx and connection errors with exponential backoff"""
+    for attempt in range(MAIL_SEND_RETRIES + 1):
+        last_attempt = attempt == MAIL_SEND_RETRIES
+        try:
+            response = SENDGRID_CLIENT.send(message)
+        except Exception as e:
+            # python_http_client raises HTTPError subclasses carrying status_code
+            status = getattr(e, "status_code", None)
+            if last_attempt or (status is not None and status != 429 and status < 500):
+                raise
+            print(f"[EMAIL] SendGrid attempt {attempt + 1} failed ({status or e}), retrying")
+        else:
+            if last_attempt or (response.status_code != 429 and response.status_code < 500):
+                return response
+            print(f"[EMAIL] SendGrid attempt {attempt + 1} returned {response.status_code}, retrying")
+        time.sleep(MAIL_RETRY_BASE_DELAY * 2 ** attempt)
 
 # =================== Admin Dashboard Functions ===================
-# OTP storage: {email: {'code': '123456', 'expires': datetime, 'attempts': 0}}
-otp_storage = {}
-# Email send tracking: {email: {'count': 5, 'reset_time': datetime, 'cooldown_until': datetime}}
-email_send_tracking = {}
+class TTLDict:
+    """
+    Size-capped dict whose entries expire ttl seconds after they were set
+    
+    Expired and overflow entries are evicted oldest-first on every insert, so
+    the dict never grows past maxsize. Hold .lock for read-modify-write sequences
+    """
+    
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.lock = threading.RLock()
+        self._data = OrderedDict()  # key -> (expires_at, value), oldest first
+    
+    def __setitem__(self, key, value):
+        with self.lock:
+            now = time.monotonic()
+            self._data.pop(key, None)
+            self._data[key] = (now + self.ttl, value)
+            # Same ttl for every entry, so insertion order is expiry order
+            while self._data:
+                expires_at, _ = next(iter(self._data.values()))
+                if expires_at > now and len(self._data) <= self.maxsize:
+                    break
+                self._data.popitem(last=False)
+    
+    def get(self, key, default=None):
+        with self.lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            if item[0] <= time.monotonic():
+                del self._data[key]
+                return default
+            return item[1]
+    
+    def pop(self, key, default=None):
+        with self.lock:
+            item = self._data.pop(key, None)
+            if item is None or item[0] <= time.monotonic():
+                return default
+            return item[1]
+
 OTP_EXPIRY_MINUTES = 10
 MAX_OTP_ATTEMPTS = 5
+# OTP storage: {email: {'code': '123456', 'attempts': 0}}, dropped after OTP_EXPIRY_MINUTES
+otp_storage = TTLDict(maxsize=10_000, ttl=OTP_EXPIRY_MINUTES * 60)
+# Email send tracking: {email: {'count': 5, 'reset_time': datetime, 'cooldown_until': datetime}}
+email_send_tracking = {}
+# Held across check + count so concurrent send-otp requests can't all pass the limit
+email_send_tracking_lock = Lock()
 EMAIL_SEND_LIMIT = 5
 EMAIL_COOLDOWN_HOURS = 1
 
@@ -986,12 +1919,10 @@ def load_auth_config():
                 ],
                 "sessions": {}
             }
-            with open(AUTH_FILE, 'w', encoding='utf-8') as f:
-                json.dump(default_config, f, indent=2)
+            dump_json_file(AUTH_FILE, default_config)
             return default_config
         
-        with open(AUTH_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
+        return load_json_cached(AUTH_FILE)
     except Exception as e:
         print(f"[AUTH] Error loading auth config: {e}")
         return {
@@ -1004,15 +1935,45 @@ def load_auth_config():
             "sessions": {}
         }
 
+# Lower-cased authorized emails, rebuilt only when auth.json changes
+_authorized_emails_cache = {"stamp": None, "emails": frozenset(), "checked_at": 0.0}
+
+def invalidate_auth_cache():
+    """Forget cached auth.json data (call after writing it)"""
+    invalidate_json_cache(AUTH_FILE)
+    _authorized_emails_cache.update(stamp=None, checked_at=0.0)
+
+def get_authorized_emails():
+    """Authorized emails from auth.json as a lower-cased frozenset"""
+    # Checked on every admin request; within the TTL skip even the stat
+    now = time.monotonic()
+    cached = _authorized_emails_cache
+    if cached["stamp"] is not None and now - cached["checked_at"] < CONFIG_CACHE_TTL:
+        return cached["emails"]
+    
+    try:
+        st = os.stat(AUTH_FILE)
+        stamp = (st.st_mtime_ns, st.st_size)
+    except FileNotFoundError:
+        stamp = None
+    
+    if stamp is not None and cached["stamp"] == stamp:
+        cached["checked_at"] = now
+        return cached["emails"]
+    
+    config = load_auth_config()
+    emails = frozenset(e.lower() for e in config.get("authorized_emails", []))
+    if stamp is not None:
+        _authorized_emails_cache.update(stamp=stamp, emails=emails, checked_at=now)
+    return emails
+
 def is_email_authorized(email):
     """Check if email is in authorized list"""
     if not email:
         return False
     
     try:
-        config = load_auth_config()
-        authorized = config.get("authorized_emails", [])
-        return email.lower() in [e.lower() for e in authorized]
+        return email.lower() in get_authorized_emails()
     except Exception as e:
         print(f"[AUTH] Error checking authorization: {e}")
         # If auth check fails, don't kick user out - let session persist
@@ -1024,16 +1985,21 @@ def is_owner_email(email):
     owner = config.get('owner_email', '').lower()
     return email.lower() == owner if owner else False
 
+ADMINS_FILE = 'data/dashboard/admins.json'
+
+def load_admins_config():
+    """admins.json (mtime-cached, read-only: writers load it fresh), {} if missing"""
+    try:
+        return load_json_cached(ADMINS_FILE)
+    except FileNotFoundError:
+        return {}
+
 def get_admin_permissions(email):
     """Get permissions for an admin email"""
     try:
-        perms_file = 'data/dashboard/admins.json'
-        if os.path.exists(perms_file):
-            with open(perms_file, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                admin_data = data.get('admins', {}).get(email.lower(), None)
-                if admin_data:
-                    return admin_data.get('permissions', {})
+        admin_data = load_admins_config().get('admins', {}).get(email.lower(), None)
+        if admin_data:
+            return admin_data.get('permissions', {})
         return {
             'dashboard': True,
             'keys': True,
@@ -1060,13 +2026,9 @@ def get_admin_role(email):
         if is_owner_email(email):
             return 'owner'
         
-        perms_file = 'data/dashboard/admins.json'
-        if os.path.exists(perms_file):
-            with open(perms_file, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                admin_data = data.get('admins', {}).get(email.lower(), None)
-                if admin_data:
-                    return admin_data.get('role', 'admin')
+        admin_data = load_admins_config().get('admins', {}).get(email.lower(), None)
+        if admin_data:
+            return admin_data.get('role', 'admin')
         return 'admin'
     except:
         return 'admin'
@@ -1090,7 +2052,21 @@ def require_owner_auth(f):
 
 def generate_otp():
     """Generate 6-digit OTP"""
-    return ''.join([str(random.randint(0, 9)) for _ in range(6)])
+    return f"{secrets.randbelow(1_000_000):06d}"
+
+# OTP email body, built once: only the code between the two halves changes per send
+_OTP_EMAIL_HEAD = '''
+            <div style="font-family: Arial, sans-serif; max-width: 600px; margin: 0 auto;">
+                <h2 style="color: #333;">Mã xác thực đăng nhập Admin Dashboard</h2>
+                <p>Mã OTP của bạn là:</p>
+                <div style="background: #f0f0f0; padding: 20px; text-align: center; font-size: 32px; font-weight: bold; letter-spacing: 5px; margin: 20px 0;">
+                    '''
+_OTP_EMAIL_TAIL = f'''
+                </div>
+                <p style="color: #666;">Mã này sẽ hết hiệu lực sau {OTP_EXPIRY_MINUTES} phút.</p>
+                <p style="color: #666; font-size: 12px;">Nếu bạn không yêu cầu mã này, vui lòng bỏ qua email này.</p>
+            </div>
+            '''
 
 def send_otp_email(email, otp):
     """Send OTP to email"""
@@ -1103,21 +2079,10 @@ def send_otp_email(email, otp):
             from_email=FROM_EMAIL,
             to_emails=email,
             subject='Mã xác thực Admin Dashboard',
-            html_content=f'''
-            <div style="font-family: Arial, sans-serif; max-width: 600px; margin: 0 auto;">
-                <h2 style="color: #333;">Mã xác thực đăng nhập Admin Dashboard</h2>
-                <p>Mã OTP của bạn là:</p>
-                <div style="background: #f0f0f0; padding: 20px; text-align: center; font-size: 32px; font-weight: bold; letter-spacing: 5px; margin: 20px 0;">
-                    {otp}
-                </div>
-                <p style="color: #666;">Mã này sẽ hết hiệu lực sau {OTP_EXPIRY_MINUTES} phút.</p>
-                <p style="color: #666; font-size: 12px;">Nếu bạn không yêu cầu mã này, vui lòng bỏ qua email này.</p>
-            </div>
-            '''
+            html_content=_OTP_EMAIL_HEAD + html.escape(otp) + _OTP_EMAIL_TAIL
         )
         
-        sg = SendGridAPIClient(SENDGRID_API_KEY)
-        response = sg.send(message)
+        response = sendgrid_send(message)
         
         if response.status_code in [200, 201, 202]:
             return True, "OTP sent successfully"
@@ -1130,29 +2095,25 @@ def send_otp_email(email, otp):
 
 def verify_otp(email, otp_code):
     """Verify OTP code"""
-    if email not in otp_storage:
-        return False, "OTP not found or expired"
-    
-    stored = otp_storage[email]
-    
-    # Check expiry
-    if datetime.now() > stored['expires']:
-        del otp_storage[email]
-        return False, "OTP expired"
-    
-    # Check attempts
-    if stored['attempts'] >= MAX_OTP_ATTEMPTS:
-        del otp_storage[email]
-        return False, "Too many failed attempts"
-    
-    # Verify code
-    if stored['code'] != otp_code:
-        otp_storage[email]['attempts'] += 1
-        return False, "Invalid OTP"
-    
-    # Success - remove OTP
-    del otp_storage[email]
-    return True, "OTP verified"
+    with otp_storage.lock:
+        # Expired OTPs are evicted by otp_storage itself
+        stored = otp_storage.get(email)
+        if stored is None:
+            return False, "OTP not found or expired"
+        
+        # Check attempts
+        if stored['attempts'] >= MAX_OTP_ATTEMPTS:
+            otp_storage.pop(email)
+            return False, "Too many failed attempts"
+        
+        # Verify code (constant time; bytes so non-ASCII input can't raise)
+        if not secrets.compare_digest(stored['code'].encode(), otp_code.encode()):
+            stored['attempts'] += 1
+            return False, "Invalid OTP"
+        
+        # Success - remove OTP
+        otp_storage.pop(email)
+        return True, "OTP verified"
 
 def check_email_send_cooldown(email):
     """Check if email is in cooldown period"""
@@ -1196,6 +2157,24 @@ def update_email_send_tracking(email):
     
     print(f"[EMAIL TRACKING] {email}: {tracking['count']}/{EMAIL_SEND_LIMIT} emails sent")
 
+def claim_email_send(email):
+    """Check the cooldown and, if clear, count this send attempt; returns (is_cooldown, message)"""
+    with email_send_tracking_lock:
+        is_cooldown, message = check_email_send_cooldown(email)
+        if not is_cooldown:
+            update_email_send_tracking(email)
+        return is_cooldown, message
+
+def release_email_send(email):
+    """Undo claim_email_send for a send that failed"""
+    with email_send_tracking_lock:
+        tracking = email_send_tracking.get(email)
+        if not tracking or tracking['count'] <= 0:
+            return
+        tracking['count'] -= 1
+        if tracking['count'] < EMAIL_SEND_LIMIT:
+            tracking.pop('cooldown_until', None)
+
 def require_admin_auth(f):
     """Decorator to require admin authentication"""
     from functools import wraps
@@ -1214,28 +2193,95 @@ def require_admin_auth(f):
         return f(*args, **kwargs)
     return decorated_function
 
-def get_all_dashboard_data():
+# Browsers must revalidate every time (cheap 304s via the ETag), so a GET
+# right after an edit never shows the pre-edit body
+ADMIN_API_CACHE_CONTROL = "private, no-cache"
+
+def _file_etag(path):
+    """Cheap validator for a file-backed payload, or None if the file is missing"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return f"{st.st_mtime_ns:x}-{st.st_size:x}"
+
+def fast_json(payload):
+    """JSON response serialized with orjson when available (falls back to jsonify)"""
+    if orjson is None:
+        return jsonify(payload)
+    return app.response_class(orjson.dumps(payload, option=orjson.OPT_NON_STR_KEYS),
+                              mimetype="application/json")
+
+def conditional_json(payload, etag=None):
+    """
+    JSON response with an ETag that answers 304 when the client already has it
+    
+    Without an explicit etag the serialized body is hashed
+    """
+    resp = fast_json(payload)
+    resp.set_etag(etag or hashlib.blake2b(resp.get_data(), digest_size=16).hexdigest())
+    resp.headers["Cache-Control"] = ADMIN_API_CACHE_CONTROL
+    return resp.make_conditional(request)
+
+def stats_snapshot():
+    """Stats for admin_api_stats: one cached read per key file, one count query"""
+    keys_by_type = {period: read_key_file(period, head=0)[0] for period in ('1d', '7d', '30d', '90d')}
+    return {
+        'total_keys': sum(keys_by_type.values()),
+        'keys_by_type': keys_by_type,
+        'total_orders': get_total_orders(),
+        'total_coupons': len(load_coupons()),
+        'recent_orders': get_recent_orders(10)
+    }
+
+# Assembled dashboard payload, reused across admin page loads for a few seconds
+DASHBOARD_CACHE_TTL = float(os.environ.get("DASHBOARD_CACHE_TTL", "15"))
+_DASH_CACHE = {"data": None, "expires": 0.0}
+_dash_cache_lock = Lock()
+
+def invalidate_dashboard_cache():
+    """Force the next get_all_dashboard_data call to rebuild"""
+    _DASH_CACHE["expires"] = 0.0
+
+def get_all_dashboard_data(force_refresh=False):
+    """Get all data for dashboard (cached for DASHBOARD_CACHE_TTL seconds)"""
+    if not force_refresh and time.monotonic() < _DASH_CACHE["expires"]:
+        return _DASH_CACHE["data"]
+    with _dash_cache_lock:
+        if not force_refresh and time.monotonic() < _DASH_CACHE["expires"]:
+            return _DASH_CACHE["data"]
+        data = _build_dashboard_data()
+        if data:
+            _DASH_CACHE["data"] = data
+            _DASH_CACHE["expires"] = time.monotonic() + DASHBOARD_CACHE_TTL
+        return data
+
+def _dashboard_data_for_request():
+    """Dashboard data for the current page; ?refresh=1 bypasses the cache"""
+    return get_all_dashboard_data(force_refresh=request.args.get("refresh") == "1")
+
+def _build_dashboard_data():
     """Get all data for dashboard"""
     try:
         order_stats = get_order_stats()
+        key_data = {}
+        for period in ('1d', '7d', '30d', '90d'):
+            count, head = read_key_file(period)
+            key_data[period] = {'count': count, 'list': head}
+        coupons = load_coupons()
         data = {
-            'key_data': {
-                '1d': {'count': count_keys('1d'), 'list': get_keys_by_type('1d')[:10]},
-                '7d': {'count': count_keys('7d'), 'list': get_keys_by_type('7d')[:10]},
-                '30d': {'count': count_keys('30d'), 'list': get_keys_by_type('30d')[:10]},
-                '90d': {'count': count_keys('90d'), 'list': get_keys_by_type('90d')[:10]},
-            },
+            'key_data': key_data,
             'prices': load_prices(),
-            'coupons': load_coupons(),
+            'coupons': coupons,
             'orders': get_recent_orders(50),
             'order_stats': order_stats,
             'settings': load_settings(),
             'stats': {
-                'total_keys': sum(count_keys(t) for t in ['1d', '7d', '30d', '90d']),
+                'total_keys': sum(k['count'] for k in key_data.values()),
                 'total_orders': order_stats['total'],
                 'paid_orders': order_stats['paid'],
                 'pending_orders': order_stats['pending'],
-                'total_coupons': len(load_coupons()),
+                'total_coupons': len(coupons),
             }
         }
         return data
@@ -1243,18 +2289,19 @@ def get_all_dashboard_data():
         print(f"[DASHBOARD DATA ERROR] {e}")
         return {}
 
+SOLVED_FILE = os.path.join(KEYS_DIR, "keys_solved.json")
+
 def get_recent_orders(limit=20):
     """Get recent orders from keys_solved.json"""
     try:
-        solved_file = "data/keys/keys_solved.json"
-        if not os.path.exists(solved_file):
+        try:
+            # Parsed once per change of the file, shared with get_order_stats
+            orders = load_json_cached(SOLVED_FILE)
+        except FileNotFoundError:
             return []
         
-        with open(solved_file, "r", encoding="utf-8") as f:
-            orders = json.load(f)
-        
-        # Sort by timestamp descending
-        orders.sort(key=lambda x: x.get('timestamp', ''), reverse=True)
+        # Newest `limit` by timestamp (the cached list itself stays untouched)
+        orders = heapq.nlargest(limit, orders, key=lambda x: x.get('timestamp', ''))
         
         # Return limited list
         return [
@@ -1278,23 +2325,17 @@ def get_recent_orders(limit=20):
 def get_total_orders():
     """Get total number of orders"""
     try:
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        cursor.execute("SELECT COUNT(*) FROM orders")
-        total = cursor.fetchone()[0]
-        conn.close()
-        return total
+        with db_conn() as conn:
+            row = conn.execute("SELECT n FROM table_counts WHERE name = 'orders'").fetchone()
+            return row[0] if row else 0
     except:
         return 0
 
 def reset_all_orders():
     """Reset all orders (delete all)""" 
     try:
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM orders")
-        conn.commit()
-        conn.close()
+        with db_conn() as conn:
+            conn.execute("DELETE FROM orders")
         print("[ORDERS] All orders deleted")
         return True
     except Exception as e:
@@ -1304,22 +2345,16 @@ def reset_all_orders():
 def delete_pending_orders(minutes=15):
     """Delete pending orders older than specified minutes"""
     try:
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        
         # Calculate cutoff time
         cutoff_time = datetime.now() - timedelta(minutes=minutes)
         cutoff_str = cutoff_time.strftime('%Y-%m-%d %H:%M:%S')
         
-        # Delete unpaid orders older than cutoff
-        cursor.execute("""
-            DELETE FROM orders 
-            WHERE paid = 0 AND created_at < ?
-        """, (cutoff_str,))
-        
-        deleted_count = cursor.rowcount
-        conn.commit()
-        conn.close()
+        # Delete unpaid orders older than cutoff (range scan on idx_orders_paid_created)
+        with db_conn() as conn:
+            deleted_count = conn.execute("""
+                DELETE FROM orders 
+                WHERE paid = 0 AND created_at < ?
+            """, (cutoff_str,)).rowcount
         
         print(f"[ORDERS CLEANUP] Deleted {deleted_count} pending orders older than {minutes} minutes")
         return deleted_count
@@ -1330,13 +2365,11 @@ def delete_pending_orders(minutes=15):
 def get_order_stats():
     """Get order statistics from keys_solved.json"""
     try:
-        solved_file = "data/keys/keys_solved.json"
-        if not os.path.exists(solved_file):
+        try:
+            orders = load_json_cached(SOLVED_FILE)
+        except FileNotFoundError:
             return {'total': 0, 'paid': 0, 'pending': 0, 'old_pending': 0}
         
-        with open(solved_file, "r", encoding="utf-8") as f:
-            orders = json.load(f)
-        
         total = len(orders)
         paid = total  # All orders in keys_solved.json are solved/paid
         pending = 0
@@ -1381,12 +2414,10 @@ def load_settings():
     }
     
     try:
-        os.makedirs(os.path.dirname(SETTINGS_FILE), exist_ok=True)
         if os.path.exists(SETTINGS_FILE):
-            with open(SETTINGS_FILE, 'r', encoding='utf-8') as f:
-                settings = json.load(f)
-                # Merge with defaults
-                return {**default_settings, **settings}
+            settings = load_json_cached(SETTINGS_FILE)
+            # Merge with defaults
+            return {**default_settings, **settings}
         return default_settings
     except Exception as e:
         print(f"[SETTINGS ERROR] Failed to load settings: {e}")
@@ -1395,9 +2426,8 @@ def load_settings():
 def save_settings(settings):
     """Save application settings"""
     try:
-        os.makedirs(os.path.dirname(SETTINGS_FILE), exist_ok=True)
-        with open(SETTINGS_FILE, 'w', encoding='utf-8') as f:
-            json.dump(settings, f, indent=2, ensure_ascii=False)
+        dump_json_file(SETTINGS_FILE, settings)
+        invalidate_dashboard_cache()
         print(f"[SETTINGS] Saved settings: {settings}")
         return True
     except Exception as e:
@@ -1405,11 +2435,16 @@ def save_settings(settings):
         return False
 
 # Auto cleanup thread
+# One Event for the worker's lifetime: waiting on it is the sleep, setting it stops the loop
+_cleanup_stop = threading.Event()
+
 def auto_cleanup_worker():
     """Background worker to auto-cleanup old pending orders"""
-    while True:
+    interval = 0  # first cycle runs right away
+    while not _cleanup_stop.wait(interval):
+        # One settings read per cycle (load_settings itself never raises)
+        settings = load_settings()
         try:
-            settings = load_settings()
             if settings.get('cleanup_enabled', True):
                 minutes = settings.get('cleanup_minutes', 15)
                 deleted = delete_pending_orders(minutes)
@@ -1419,14 +2454,13 @@ def auto_cleanup_worker():
             print(f"[AUTO CLEANUP ERROR] {e}")
         
         # Wait for next cleanup cycle
-        settings = load_settings()
         interval = settings.get('auto_cleanup_interval', 300)
-        threading.Event().wait(interval)
 
 def start_auto_cleanup():
     """Start auto cleanup in background thread"""
     cleanup_thread = threading.Thread(target=auto_cleanup_worker, daemon=True)
     cleanup_thread.start()
+    atexit.register(_cleanup_stop.set)
     print("[AUTO CLEANUP] Background cleanup thread started")
 
 # =================== Flask Routes ===================
@@ -1440,10 +2474,10 @@ def index():
     prices = load_prices()
     
     durations = [
-        {"category": "v1", "label": prices["1d"]["label"], "value": "1d", "amount": prices["1d"]["amount"], "key_count": count_keys("1d")},
-        {"category": "v1", "label": prices["7d"]["label"], "value": "7d", "amount": prices["7d"]["amount"], "key_count": count_keys("7d")},
-        {"category": "v1", "label": prices["30d"]["label"], "value": "30d", "amount": prices["30d"]["amount"], "key_count": count_keys("30d")},
-        {"category": "v1", "label": prices["90d"]["label"], "value": "90d", "amount": prices["90d"]["amount"], "key_count": count_keys("90d")},
+        {"category": "v1", "label": prices["1d"]["label"], "value": "1d", "amount": prices["1d"]["amount"], "key_count": indexed_key_count("1d")},
+        {"category": "v1", "label": prices["7d"]["label"], "value": "7d", "amount": prices["7d"]["amount"], "key_count": indexed_key_count("7d")},
+        {"category": "v1", "label": prices["30d"]["label"], "value": "30d", "amount": prices["30d"]["amount"], "key_count": indexed_key_count("30d")},
+        {"category": "v1", "label": prices["90d"]["label"], "value": "90d", "amount": prices["90d"]["amount"], "key_count": indexed_key_count("90d")},
     ]
     return render_template("index.html", uid=uid, code=code, durations=durations)
 
@@ -1492,6 +2526,137 @@ def check_coupon():
             "message": err_msg or "Mã giảm giá không hợp lệ"
         }), 400
 
+# Cached MB transaction list shared by all payment pollers
+MB_CACHE_TTL = float(os.environ.get("MB_CACHE_TTL", "8"))
+# A failed fetch is re-raised to pollers for this long instead of being retried by each
+MB_ERROR_TTL = 2.0
+# Payments older than this never match an order
+MB_TX_WINDOW_SECONDS = 86400 * 3
+_mb_cache = {"at": 0.0, "transactions": [], "amounts": [], "entries": [], "error": None, "error_at": 0.0}
+# Guards _mb_cache and _mb_fetch["done"] only; the upstream fetch runs without it
+_mb_cache_lock = Lock()
+# Event of the fetch in flight (single flight), None when idle
+_mb_fetch = {"done": None}
+
+def _parse_mb_dt(s):
+    """Parse MBBank "dd/mm/YYYY HH:MM:SS" timestamps, slicing the usual zero-padded shape"""
+    if len(s) != 19 or s[2] != "/" or s[5] != "/" or s[10] != " " or s[13] != ":" or s[16] != ":":
+        # e.g. "5/3/2025 9:07:01": strptime accepts unpadded fields
+        return datetime.strptime(s, "%d/%m/%Y %H:%M:%S")
+    return datetime(int(s[6:10]), int(s[3:5]), int(s[0:2]), int(s[11:13]), int(s[14:16]), int(s[17:19]))
+
+def _mb_tx_time(tx):
+    """Parsed transactionDate of an MB transaction, or None if unparseable"""
+    try:
+        return _parse_mb_dt(tx.get("transactionDate", ""))
+    except ValueError:
+        return None
+
+def _index_mb_transactions(transactions):
+    """
+    Pre-process incoming transactions once per fetch
+    
+    Returns (amounts, entries) sorted by amount, where each entry is
+    (amount, position, description_upper, tx_time, tx) so pollers can bisect to
+    the transactions paying at least the expected amount.
+    Rows older than MB_TX_WINDOW_SECONDS are dropped; when the feed is
+    newest-first the scan stops at the first such row.
+    """
+    entries = []
+    cutoff = datetime.now() - timedelta(seconds=MB_TX_WINDOW_SECONDS)
+    
+    # Decide ordering from the two ends rather than trusting the API
+    newest_first = False
+    if len(transactions) > 1:
+        first_time = _mb_tx_time(transactions[0])
+        last_time = _mb_tx_time(transactions[-1])
+        newest_first = first_time is not None and last_time is not None and first_time >= last_time
+    
+    append = entries.append
+    tx_time_of = _mb_tx_time
+    for pos, tx in enumerate(transactions):
+        # Cheap type filter first; dates are only parsed for incoming rows
+        if tx.get("type", "") != "IN":
+            continue
+        tx_time = tx_time_of(tx)
+        if tx_time is not None and tx_time < cutoff:
+            if newest_first:
+                break
+            continue
+        try:
+            # Support both "amount" and "creditAmount" fields
+            amount = int(float(tx.get("amount") or tx.get("creditAmount", "0")))
+        except (TypeError, ValueError):
+            continue
+        append((amount, pos, tx.get("description", "").upper(), tx_time, tx))
+    entries.sort(key=lambda e: (e[0], e[1]))
+    return [e[0] for e in entries], entries
+
+def _fetch_mb_transactions():
+    """One upstream fetch + index, returns (transactions, amounts, entries)"""
+    resp = MB_SESSION.send(mb_prepared_request(), timeout=15)
+    resp.raise_for_status()
+    payload = orjson.loads(resp.content) if orjson else resp.json()
+    transactions = payload.get("transactions", [])
+    amounts, entries = _index_mb_transactions(transactions)
+    return transactions, amounts, entries
+
+def _mb_snapshot():
+    """
+    (transactions, amounts, entries), fetching upstream at most once per MB_CACHE_TTL
+    
+    One thread fetches with the lock released; meanwhile other pollers get the
+    previous snapshot, or wait for the fetch if there is none yet
+    """
+    while True:
+        with _mb_cache_lock:
+            now = time.monotonic()
+            snapshot = _mb_cache["transactions"], _mb_cache["amounts"], _mb_cache["entries"]
+            if now - _mb_cache["at"] <= MB_CACHE_TTL:
+                return snapshot
+            if _mb_cache["error"] is not None and now - _mb_cache["error_at"] < MB_ERROR_TTL:
+                raise _mb_cache["error"]
+            done = _mb_fetch["done"]
+            if done is None:
+                done = _mb_fetch["done"] = threading.Event()
+                break
+            if _mb_cache["at"]:
+                return snapshot
+        done.wait()
+    
+    try:
+        snapshot = _fetch_mb_transactions()
+    except Exception as e:
+        with _mb_cache_lock:
+            _mb_cache["error"], _mb_cache["error_at"] = e, time.monotonic()
+        raise
+    else:
+        with _mb_cache_lock:
+            _mb_cache["transactions"], _mb_cache["amounts"], _mb_cache["entries"] = snapshot
+            _mb_cache["at"] = time.monotonic()
+            _mb_cache["error"] = None
+        return snapshot
+    finally:
+        with _mb_cache_lock:
+            _mb_fetch["done"] = None
+        done.set()
+
+def get_mb_transactions():
+    """Get MB transactions, fetching upstream at most once per MB_CACHE_TTL seconds"""
+    return _mb_snapshot()[0]
+
+def get_mb_index():
+    """Get (amounts, entries) index of incoming MB transactions"""
+    return _mb_snapshot()[1:]
+
+# Identical payment checks (same uid/period/amount/promo) are collapsed: one
+# runs, concurrent duplicates wait for it, and its answer is reused briefly
+PAYMENT_CHECK_REUSE_SECONDS = 5
+PAYMENT_CHECK_WAIT_SECONDS = 5
+_recent_payment_checks = TTLDict(maxsize=10_000, ttl=PAYMENT_CHECK_REUSE_SECONDS)
+_payment_checks_inflight = {}
+_payment_checks_inflight_lock = Lock()
+
 @app.route("/api/check_payment_status", methods=["POST"])
 def check_payment_status():
     """Check if payment exists in MBBank API"""
@@ -1504,19 +2669,43 @@ def check_payment_status():
     if not uid:
         return jsonify({"status": "error", "message": "Thiếu UID!"}), 400
 
-    print(f"[PAYMENT CHECK] Checking for UID: {uid}")
+    check_key = (uid, period_code, amount, promo_code)
+    cached = _recent_payment_checks.get(check_key)
+    if cached is not None:
+        return jsonify(cached)
+    
+    with _payment_checks_inflight_lock:
+        done = _payment_checks_inflight.get(check_key)
+        leader = done is None
+        if leader:
+            done = _payment_checks_inflight[check_key] = threading.Event()
+    
+    if not leader:
+        # Another request is already checking this order; reuse its answer
+        done.wait(PAYMENT_CHECK_WAIT_SECONDS)
+        cached = _recent_payment_checks.get(check_key)
+        if cached is not None:
+            return jsonify(cached)
+        payload, status_code = _check_payment(uid, period_code, amount, promo_code)
+        return jsonify(payload), status_code
+    
+    try:
+        payload, status_code = _check_payment(uid, period_code, amount, promo_code)
+        if status_code == 200:
+            _recent_payment_checks[check_key] = payload
+    finally:
+        with _payment_checks_inflight_lock:
+            _payment_checks_inflight.pop(check_key, None)
+        done.set()
+    return jsonify(payload), status_code
+
+def _check_payment(uid, period_code, amount, promo_code):
+    """Look for the order's payment in the MB feed, returns (payload, status_code)"""
+    logger.debug("[PAYMENT CHECK] Checking for UID: %s", uid)
 
     # Check MBBank API for payment
     try:
-        session_req = requests.Session()
-        session_req.headers.update({
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64)",
-            "Accept": "application/json, text/plain, */*",
-            "Connection": "keep-alive"
-        })
-        resp = session_req.get(MB_API_URL, timeout=15)
-        resp.raise_for_status()
-        transactions = resp.json().get("transactions", [])
+        amounts, entries = get_mb_index()
     except Exception as e:
         # Log API error to Discord
         try:
@@ -1526,9 +2715,9 @@ def check_payment_status():
                 details=f"UID: {uid}, Period: {period_code}, Amount: {amount}"
             )
         except Exception as webhook_err:
-            print(f"[WEBHOOK] ⚠️ Failed to send Discord notification: {webhook_err}")
+            logger.warning("[WEBHOOK] ⚠️ Failed to send Discord notification: %s", webhook_err)
         
-        return jsonify({"status": "error", "message": f"Lỗi đọc API MB: {e}"}), 500
+        return {"status": "error", "message": f"Lỗi đọc API MB: {e}"}, 500
 
     now = datetime.now()
     found_tx = None
@@ -1543,70 +2732,66 @@ def check_payment_status():
         else:
             # Fallback to old promo system
             promo = get_promo(promo_code)
-            if promo and promo[2] > 0 and (not promo[3] or datetime.fromisoformat(promo[3]) > now):
-                discount_percent = promo[1]
+            if promo and promo["uses_left"] > 0 and (not promo["expires_at"] or datetime.fromisoformat(promo["expires_at"]) > now):
+                discount_percent = promo["discount"]
     
     final_amount = round(amount * (100 - discount_percent) / 100)
 
-    print(f"[PAYMENT CHECK] Looking for UID: {uid} | Expected amount: {final_amount}")
+    logger.debug("[PAYMENT CHECK] Looking for UID: %s | Expected amount: %s", uid, final_amount)
 
-    for tx in transactions:
-        tx_type = tx.get("type", "")
-        tx_time_str = tx.get("transactionDate", "")
+    # Only incoming transactions paying at least final_amount can match;
+    # keep the API's original order among those that mention the UID
+    uid_upper = uid.upper()
+    min_time = now - timedelta(seconds=MB_TX_WINDOW_SECONDS)
+    start = bisect.bisect_left(amounts, final_amount)
+    candidates = sorted(
+        (e for e in entries[start:] if uid_upper in e[2]),
+        key=lambda e: e[1]
+    )
+    
+    for tx_amount, _, _, tx_time, tx in candidates:
         tx_content = tx.get("description", "")
         
-        # Support both "amount" and "creditAmount" fields
-        tx_amount_str = tx.get("amount") or tx.get("creditAmount", "0")
-        tx_amount = int(float(tx_amount_str))
-        
-        # Only check incoming transactions
-        if tx_type != "IN":
-            continue
+        logger.debug("[PAYMENT CHECK] ✅ FOUND UID in TX: %.100s", tx_content)
+        logger.debug("[PAYMENT CHECK] Amount: %s (expected: %s)", tx_amount, final_amount)
         
-        # Check if UID matches (case insensitive)
-        if uid.upper() in tx_content.upper():
-            print(f"[PAYMENT CHECK] ✅ FOUND UID in TX: {tx_content[:100]}")
-            print(f"[PAYMENT CHECK] Amount: {tx_amount} (expected: {final_amount})")
-            
-            if tx_amount >= final_amount:
+        try:
+            if tx_time is None:
+                raise ValueError(f"unexpected MB transaction date: {tx.get('transactionDate', '')!r}")
+            if tx_time >= min_time:
+                logger.info("[PAYMENT CHECK] ✅ PAYMENT CONFIRMED! UID: %s", uid)
+                found_tx = tx
+                
+                # Log to Discord
                 try:
-                    tx_time = datetime.strptime(tx_time_str, "%d/%m/%Y %H:%M:%S")
-                    if (now - tx_time).total_seconds() <= 86400 * 3:  # 3 days
-                        print(f"[PAYMENT CHECK] ✅ PAYMENT CONFIRMED! UID: {uid}")
-                        found_tx = tx
-                        
-                        # Log to Discord
-                        try:
-                            webhooklog.log_payment_confirmed(
-                                uid=uid,
-                                amount=final_amount,
-                                period=period_code,
-                                promo_code=promo_code if promo_code else None,
-                                tx_details=tx_content
-                            )
-                        except Exception as webhook_err:
-                            print(f"[WEBHOOK] ⚠️ Failed to send Discord notification: {webhook_err}")
-                        
-                        break
-                    else:
-                        print(f"[PAYMENT CHECK] ❌ Transaction too old")
-                except Exception as e:
-                    print(f"[PAYMENT CHECK] ❌ Date parse error: {e}")
-                    continue
+                    webhooklog.log_payment_confirmed(
+                        uid=uid,
+                        amount=final_amount,
+                        period=period_code,
+                        promo_code=promo_code if promo_code else None,
+                        tx_details=tx_content
+                    )
+                except Exception as webhook_err:
+                    logger.warning("[WEBHOOK] ⚠️ Failed to send Discord notification: %s", webhook_err)
+                
+                break
             else:
-                print(f"[PAYMENT CHECK] ❌ Amount mismatch: {tx_amount} < {final_amount}")
+                logger.debug("[PAYMENT CHECK] ❌ Transaction too old")
+        except Exception as e:
+            logger.warning("[PAYMENT CHECK] ❌ Date parse error: %s", e)
+            continue
     
     if found_tx:
-        return jsonify({
+        return {
             "status": "paid",
             "message": "Thanh toán thành công!",
             "transaction_data": found_tx
-        })
+        }, 200
     else:
-        return jsonify({
+        return {
             "status": "pending",
             "message": "Chưa tìm thấy giao dịch"
-        })
+        }, 200
 
 @app.route("/api/create_order", methods=["POST"])
 def create_order():
@@ -1621,7 +2806,7 @@ def create_order():
     # Check if order already exists
     existing_order = get_order(uid)
     if existing_order:
-        print(f"[CREATE ORDER] ⚠️ Order already exists for UID: {uid} (created at {existing_order[7]})")
+        print(f"[CREATE ORDER] ⚠️ Order already exists for UID: {uid} (created at {existing_order['created_at']})")
         return jsonify({"status": "ok", "uid": uid, "note": "Order already exists"})
     
     # Insert new order into database
@@ -1640,69 +2825,88 @@ def create_order():
         print(f"[CREATE ORDER] ❌ Failed to create order: {e}")
         return jsonify({"status": "error", "message": f"Lỗi tạo đơn: {e}"}), 500
 
-@app.route("/api/send_key", methods=["POST"])
-def send_key_endpoint():
-    """Send key to email after payment confirmation"""
-    data = request.json
-    uid = data.get("uid")
-    email = data.get("email")
-    period_code = data.get("period", "30d")
-    amount = int(data.get("amount", 10000))
-    promo_code = data.get("promo_code", "").upper()
+# UIDs whose key delivery is in progress; a second send_key for the same
+# order is refused until the first one has finished
+delivering_uids = set()
+delivering_uids_lock = Lock()
 
-    if not uid or not email:
-        print(f"[SEND KEY] ❌ Missing UID or email")
-        return jsonify({"status": "error", "message": "Thiếu thông tin!"}), 400
+def _claim_delivery(uid):
+    """Mark uid as being delivered, False if a delivery is already in flight"""
+    with delivering_uids_lock:
+        if uid in delivering_uids:
+            return False
+        delivering_uids.add(uid)
+        return True
 
-    period_map = {"1d": "1 day", "7d": "7 day", "30d": "30 day", "90d": "90 day"}
-    period = period_map.get(period_code, "30 day")
+def _release_delivery(uid):
+    with delivering_uids_lock:
+        delivering_uids.discard(uid)
 
-    # Apply coupon discount
-    discount_percent = 0
-    coupon_used_flag = False
-    is_new_coupon_system = True
-    
-    if promo_code:
-        coupon, err_msg = get_coupon(promo_code)
-        if coupon and is_coupon_valid(coupon, [period_code]):
-            discount_percent = coupon["discount"]
-            coupon_used_flag = True
-        else:
-            promo = get_promo(promo_code)
-            if promo and promo[2] > 0:
-                discount_percent = promo[1]
-                coupon_used_flag = True
-                is_new_coupon_system = False
+def _log_failed_delivery(uid, email, key, period_code, err):
+    """Log failed key delivery to Discord"""
+    try:
+        webhooklog.log_key_sent(
+            uid=uid,
+            email=email,
+            key=key,
+            period=period_code,
+            success=False,
+            error_msg=err
+        )
+    except Exception as webhook_err:
+        print(f"[WEBHOOK] ⚠️ Failed to send Discord notification: {webhook_err}")
 
-    final_amount = round(amount * (100 - discount_percent) / 100)
+def _finish_key_delivery(ok, err, uid, email, key, period, period_code, final_amount,
+                         promo_code, coupon_used_flag, is_new_coupon_system, discount_percent):
+    """
+    Handle the send result; returns (ok, error message for the client)
     
-    # Generate key
-    key = generate_key(period)
-    if not key:
-        return jsonify({"status": "error", "message": "Không tạo được key từ server!"}), 500
-
-    # Send email
-    ok, err = send_key(email, key, uid, period)
+    The order row (and legacy promo use) is recorded here, before replying, so
+    a client retrying send_key finds the key on the order; Discord, the key
+    file and the new-system coupon are handled on DELIVERY_EXECUTOR so the
+    request thread isn't held by them
+    """
     if not ok:
         print(f"[SEND KEY] ❌ Email failed: {err}")
         
-        # Log failed key delivery to Discord
-        try:
-            webhooklog.log_key_sent(
-                uid=uid,
-                email=email,
-                key=key,
-                period=period_code,
-                success=False,
-                error_msg=err
-            )
-        except Exception as webhook_err:
-            print(f"[WEBHOOK] ⚠️ Failed to send Discord notification: {webhook_err}")
-        
-        return jsonify({"status": "error", "message": f"Không gửi được email: {err}"}), 500
+        # Key was not delivered, make it available again
+        release_key(key)
+        _release_delivery(uid)
+        DELIVERY_EXECUTOR.submit(_log_failed_delivery, uid, email, key, period_code, err)
+        return False, f"Không gửi được email: {err}"
 
     print(f"[SEND KEY] ✅ Email sent successfully to {email}")
+    try:
+        complete_order(
+            uid,
+            email,
+            key,
+            promo_code=promo_code if coupon_used_flag else None,
+            use_promo=coupon_used_flag and not is_new_coupon_system
+        )
+    except Exception:
+        # The customer has the key, so this is still a success for them
+        logger.exception("[SEND KEY] Failed to update order %s after emailing its key", uid)
     
+    DELIVERY_EXECUTOR.submit(
+        _record_key_delivery, uid, email, key, period, period_code, final_amount,
+        promo_code, coupon_used_flag, is_new_coupon_system, discount_percent
+    )
+    return True, None
+
+def _record_key_delivery(uid, email, key, period, period_code, final_amount,
+                         promo_code, coupon_used_flag, is_new_coupon_system, discount_percent):
+    """Log a delivered key and consume the key and coupon"""
+    try:
+        _consume_delivered_key(uid, email, key, period, period_code, final_amount,
+                               promo_code, coupon_used_flag, is_new_coupon_system, discount_percent)
+    except Exception:
+        logger.exception("[SEND KEY] Post-delivery bookkeeping failed for %s", uid)
+    finally:
+        _release_delivery(uid)
+
+def _consume_delivered_key(uid, email, key, period, period_code, final_amount,
+                           promo_code, coupon_used_flag, is_new_coupon_system, discount_percent):
     # Log successful key delivery to Discord
     try:
         webhooklog.log_key_sent(
@@ -1737,15 +2941,124 @@ def send_key_endpoint():
     )
     if success:
         print(f"[SEND KEY] ✅ Key moved to keys_solved.json with order info")
+        release_key(key)
     else:
+        # Keep it reserved so it is not sold again while still in the file
         print(f"[SEND KEY] ⚠️ Failed to delete key (already sent to email)")
     
-    # Use coupon after successful email sending
-    if coupon_used_flag:
-        if is_new_coupon_system:
-            use_coupon(promo_code)
+    if coupon_used_flag and is_new_coupon_system:
+        use_coupon(promo_code)
+    return True
+
+@app.route("/api/send_key", methods=["POST"])
+def send_key_endpoint():
+    """Send key to email after payment confirmation"""
+    data = request.json
+    uid = data.get("uid")
+    email = data.get("email")
+    period_code = data.get("period", "30d")
+    amount = int(data.get("amount", 10000))
+    promo_code = data.get("promo_code", "").upper()
+
+    if not uid or not email:
+        print(f"[SEND KEY] ❌ Missing UID or email")
+        return jsonify({"status": "error", "message": "Thiếu thông tin!"}), 400
+
+    period = CODE_TO_PERIOD.get(period_code, "30 day")
+
+    if not _claim_delivery(uid):
+        print(f"[SEND KEY] ⏳ Delivery for {uid} already in progress")
+        return jsonify({
+            "status": "ok",
+            "message": f"⏳ Key {period} đang được gửi về {email}.",
+            "data": {"period": period, "pending": True}
+        })
+    try:
+        return _send_key_for_order(uid, email, period, period_code, amount, promo_code)
+    except Exception:
+        _release_delivery(uid)
+        raise
+
+def _send_key_for_order(uid, email, period, period_code, amount, promo_code):
+    """Body of send_key_endpoint; the caller holds the delivery claim for uid"""
+    # A retried request for an order that already got its key must not take
+    # (and email) a second one from stock
+    order = get_order(uid)
+    if order is not None and order["paid"] and order["key"]:
+        _release_delivery(uid)
+        print(f"[SEND KEY] ℹ️ Order {uid} already has its key, not sending another")
+        return jsonify({
+            "status": "ok",
+            "message": f"✅ Key {period} đã được gửi về {order['email'] or email}.",
+            "data": {"period": period, "already_sent": True}
+        })
+    
+    # Apply coupon discount
+    discount_percent = 0
+    coupon_used_flag = False
+    is_new_coupon_system = True
+    
+    if promo_code:
+        coupon, err_msg = get_coupon(promo_code)
+        if coupon and is_coupon_valid(coupon, [period_code]):
+            discount_percent = coupon["discount"]
+            coupon_used_flag = True
         else:
-            decrement_promo(promo_code)
+            promo = get_promo(promo_code)
+            if promo and promo["uses_left"] > 0:
+                discount_percent = promo["discount"]
+                coupon_used_flag = True
+                is_new_coupon_system = False
+                # The stored spelling, so decrement_promo hits exactly this row
+                promo_code = promo["code"]
+
+    final_amount = round(amount * (100 - discount_percent) / 100)
+    
+    # Generate key
+    key = generate_key(period)
+    if not key:
+        _release_delivery(uid)
+        return jsonify({"status": "error", "message": "Không tạo được key từ server!"}), 500
+
+    delivery_args = (uid, email, key, period, period_code, final_amount,
+                     promo_code, coupon_used_flag, is_new_coupon_system, discount_percent)
+    
+    # Render here; only the SendGrid round trip goes to the mail pool
+    message, err = build_key_message(email, key, uid, period)
+    if message is None:
+        _finish_key_delivery(False, err, *delivery_args)
+        return jsonify({"status": "error", "message": f"Không gửi được email: {err}"}), 500
+    
+    # Send email in the background; wait briefly so the usual case still
+    # reports the real result, otherwise finish the order once it completes
+    future = submit_mail(deliver_key_message, message, email, uid)
+    try:
+        ok, err = future.result(timeout=MAIL_RESULT_TIMEOUT)
+    except FutureTimeout:
+        print(f"[SEND KEY] ⏳ Email to {email} still sending, finishing order in background")
+        
+        def on_sent(f):
+            try:
+                ok, err = f.result()
+            except Exception as e:
+                ok, err = False, str(e)
+            _finish_key_delivery(ok, err, *delivery_args)
+        
+        future.add_done_callback(on_sent)
+        return jsonify({
+            "status": "ok",
+            "message": f"⏳ Key {period} đang được gửi về {email}.",
+            "data": {
+                "period": period,
+                "discount_percent": discount_percent,
+                "final_amount": final_amount,
+                "pending": True
+            }
+        })
+
+    ok, err = _finish_key_delivery(ok, err, *delivery_args)
+    if not ok:
+        return jsonify({"status": "error", "message": err}), 500
 
     return jsonify({
         "status": "ok",
@@ -1768,14 +3081,11 @@ def lookup_order_endpoint():
         return jsonify({"status": "error", "message": "Vui lòng nhập mã giao dịch!"}), 400
     
     # Search in orders database
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute(
-        "SELECT uid, email, key, verification_code, paid, created_at FROM orders WHERE verification_code = ? AND paid = 1",
-        (transaction_code,)
-    )
-    order = c.fetchone()
-    conn.close()
+    with db_conn() as conn:
+        order = conn.execute(
+            "SELECT uid, email, key, verification_code, paid, created_at FROM orders WHERE verification_code = ? AND paid = 1",
+            (transaction_code,)
+        ).fetchone()
     
     if order:
         uid, email, key, verification_code, paid, created_at = order
@@ -1797,101 +3107,83 @@ def lookup_order_endpoint():
         })
 
 # =================== API Status Endpoint ===================
-@app.route("/api/mbbank/status", methods=["GET"])
-def mbbank_api_status():
-    """Check MBBank API status"""
+def _probe_mb_api():
+    """Hit MB_API_URL once (bypassing the transaction cache) and describe its health"""
     try:
-        session_req = requests.Session()
-        session_req.headers.update({
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64)",
-            "Accept": "application/json, text/plain, */*",
-            "Connection": "keep-alive"
-        })
-        
-        start_time = datetime.now()
-        resp = session_req.get(MB_API_URL, timeout=10)
-        response_time = (datetime.now() - start_time).total_seconds() * 1000
+        resp = MB_SESSION.send(mb_prepared_request(), timeout=10)
+        response_time = resp.elapsed.total_seconds() * 1000
         
         if resp.status_code == 200:
-            data = resp.json()
+            data = orjson.loads(resp.content) if orjson else resp.json()
             transactions = data.get("transactions", [])
             
-            return jsonify({
+            return {
                 "status": "ok",
                 "online": True,
                 "response_time_ms": round(response_time, 2),
                 "transaction_count": len(transactions),
                 "timestamp": datetime.now().isoformat(),
                 "message": "API hoạt động bình thường"
-            }), 200
+            }
         else:
-            return jsonify({
+            return {
                 "status": "error",
                 "online": False,
                 "response_time_ms": round(response_time, 2),
                 "http_status": resp.status_code,
                 "timestamp": datetime.now().isoformat(),
                 "message": f"API trả về mã lỗi {resp.status_code}"
-            }), 200
+            }
             
     except requests.exceptions.Timeout:
-        return jsonify({
+        return {
             "status": "error",
             "online": False,
             "timestamp": datetime.now().isoformat(),
             "message": "API timeout (không phản hồi trong 10s)"
-        }), 200
+        }
         
     except Exception as e:
-        return jsonify({
+        return {
             "status": "error",
             "online": False,
             "timestamp": datetime.now().isoformat(),
             "message": f"Lỗi kết nối: {str(e)}"
-        }), 200
+        }
+
+@app.route("/api/mbbank/status", methods=["GET"])
+def mbbank_api_status():
+    """Check MBBank API status"""
+    return jsonify(_probe_mb_api()), 200
 
 # =================== Debug Endpoints ===================
 @app.route("/debug/key-status", methods=["GET"])
 def debug_key_status():
     """Debug endpoint: Kiểm tra status của key files và delivery log"""
-    keys_dir = os.path.join("data", "keys")
-    key_files = ["key1d.txt", "key7d.txt", "key30d.txt", "key90d.txt"]
-    
+    present = existing_key_files(KEYS_DIR)
     file_status = {}
     total_keys = 0
-    for key_file in key_files:
-        full_path = os.path.join(keys_dir, key_file)
-        if os.path.exists(full_path):
-            with open(full_path, "r", encoding="utf-8") as f:
-                lines = [line.strip() for line in f.readlines() if line.strip()]
+    for period, key_file in KEY_FILE_NAMES.items():
+        if key_file in present:
+            count, sample = read_key_file(period, head=3)  # First 3 lines
             file_status[key_file] = {
                 "exists": True,
-                "line_count": len(lines),
-                "sample": lines[:3] if lines else []  # First 3 lines
+                "line_count": count,
+                "sample": sample
             }
-            total_keys += len(lines)
+            total_keys += count
         else:
             file_status[key_file] = {"exists": False}
     
     # Get delivery log
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("""
-        SELECT uid, email, key, period, sent_at 
-        FROM key_delivery_log 
-        ORDER BY sent_at DESC 
-        LIMIT 20
-    """)
-    recent_deliveries = []
-    for row in c.fetchall():
-        recent_deliveries.append({
-            "uid": row[0],
-            "email": row[1],
-            "key": row[2],
-            "period": row[3],
-            "sent_at": row[4]
-        })
-    conn.close()
+    with db_conn() as conn:
+        rows = conn.execute("""
+            SELECT uid, email, key, period, sent_at 
+            FROM key_delivery_log 
+            ORDER BY sent_at DESC 
+            LIMIT 20
+        """).fetchall()
+    recent_deliveries = [dict(row) for row in rows]
     
     return jsonify({
         "status": "ok",
@@ -1904,39 +3196,33 @@ def debug_key_status():
 @app.route("/debug/check-key/<key>", methods=["GET"])
 def debug_check_key(key):
     """Debug endpoint: Kiểm tra một key cụ thể xem nó ở file nào"""
-    keys_dir = os.path.join("data", "keys")
-    key_files = ["key1d.txt", "key7d.txt", "key30d.txt", "key90d.txt"]
+    keys_dir = KEYS_DIR
+    key_files = KEY_FILE_NAMES.values()
     
+    present = existing_key_files(keys_dir)
     found_in = []
     for key_file in key_files:
-        full_path = os.path.join(keys_dir, key_file)
-        if os.path.exists(full_path):
-            with open(full_path, "r", encoding="utf-8") as f:
-                lines = [line.strip() for line in f.readlines() if line.strip()]
-            if key in lines:
-                found_in.append(key_file)
+        if key_file in present:
+            full_path = os.path.join(keys_dir, key_file)
+            try:
+                if key in load_key_set(full_path):
+                    found_in.append(key_file)
+            except FileNotFoundError:
+                pass
     
     # Check delivery log
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("""
-        SELECT uid, email, period, sent_at 
-        FROM key_delivery_log 
-        WHERE key = ?
-    """, (key,))
-    delivery_info = c.fetchone()
-    conn.close()
+    with db_conn() as conn:
+        delivery_info = conn.execute("""
+            SELECT uid, email, period, sent_at 
+            FROM key_delivery_log 
+            WHERE key = ?
+        """, (key,)).fetchone()
     
     return jsonify({
         "status": "ok",
         "key": key,
         "found_in_files": found_in if found_in else "NOT FOUND",
-        "delivery_log": {
-            "uid": delivery_info[0],
-            "email": delivery_info[1],
-            "period": delivery_info[2],
-            "sent_at": delivery_info[3]
-        } if delivery_info else None
+        "delivery_log": dict(delivery_info) if delivery_info else None
     })
 
 @app.route("/debug/auth-config", methods=["GET"])
@@ -1977,9 +3263,8 @@ def debug_reset_auth():
   "sessions": {}
 }
         
-        os.makedirs(os.path.dirname(AUTH_FILE), exist_ok=True)
-        with open(AUTH_FILE, 'w', encoding='utf-8') as f:
-            json.dump(default_config, f, indent=2)
+        dump_json_file(AUTH_FILE, default_config)
+        invalidate_auth_cache()
         
         return jsonify({
             "status": "ok",
@@ -2085,8 +3370,9 @@ def admin_send_otp():
         if not is_email_authorized(email):
             return jsonify({'success': False, 'message': 'Email không có quyền truy cập'})
         
-        # Check cooldown period
-        is_cooldown, cooldown_message = check_email_send_cooldown(email)
+        # Check cooldown period and count this attempt right away, so a burst
+        # of requests can't all get in before the first email is sent
+        is_cooldown, cooldown_message = claim_email_send(email)
         if is_cooldown:
             return jsonify({'success': False, 'message': cooldown_message})
         
@@ -2094,24 +3380,32 @@ def admin_send_otp():
         otp = generate_otp()
         otp_storage[email] = {
             'code': otp,
-            'expires': datetime.now() + timedelta(minutes=OTP_EXPIRY_MINUTES),
             'attempts': 0
         }
         
-        # Send OTP
-        success, message = send_otp_email(email, otp)
-        
-        if success:
-            # Update send tracking only if email sent successfully
-            update_email_send_tracking(email)
+        # Send OTP in the background; the admin just waits for the email
+        def on_otp_sent(future):
+            try:
+                success, message = future.result()
+            except Exception as e:
+                success, message = False, str(e)
             
-            return jsonify({
-                'success': True,
-                'message': f'Mã OTP đã được gửi đến {email}',
-                'expires_in': OTP_EXPIRY_MINUTES
-            })
-        else:
-            return jsonify({'success': False, 'message': f'Lỗi gửi email: {message}'})
+            if not success:
+                print(f"[SEND OTP ERROR] {email}: {message}")
+                # Only delivered emails count towards EMAIL_SEND_LIMIT
+                release_email_send(email)
+                # Drop the OTP nobody received (unless a newer one replaced it)
+                with otp_storage.lock:
+                    if otp_storage.get(email, {}).get('code') == otp:
+                        otp_storage.pop(email)
+        
+        submit_mail(send_otp_email, email, otp).add_done_callback(on_otp_sent)
+        
+        return jsonify({
+            'success': True,
+            'message': f'Mã OTP đã được gửi đến {email}',
+            'expires_in': OTP_EXPIRY_MINUTES
+        })
             
     except Exception as e:
         print(f"[SEND OTP ERROR] {e}")
@@ -2205,13 +3499,13 @@ def admin_login_password():
 @require_admin_auth
 def admin_dashboard():
     """Admin dashboard page - redirect to home"""
-    return redirect(url_for('admin_dashboard_home'))
+    return redirect(url_for('admin_dashboard_home', **request.args))
 
 @app.route("/admin/dashboard/home")
 @require_admin_auth  
 def admin_dashboard_home():
     """Admin dashboard home page"""
-    data = get_all_dashboard_data()
+    data = _dashboard_data_for_request()
     return render_template('dashboard/home.html', 
                          data=data, 
                          admin_email=session.get('admin_email'),
@@ -2221,7 +3515,7 @@ def admin_dashboard_home():
 @require_admin_auth
 def admin_dashboard_keys():
     """Keys management page"""
-    data = get_all_dashboard_data()
+    data = _dashboard_data_for_request()
     return render_template('dashboard/keys.html',
                          data=data,
                          admin_email=session.get('admin_email'),
@@ -2231,7 +3525,7 @@ def admin_dashboard_keys():
 @require_admin_auth
 def admin_dashboard_orders():
     """Orders management page"""
-    data = get_all_dashboard_data()
+    data = _dashboard_data_for_request()
     return render_template('dashboard/orders.html',
                          data=data,
                          admin_email=session.get('admin_email'),
@@ -2241,7 +3535,7 @@ def admin_dashboard_orders():
 @require_admin_auth
 def admin_dashboard_prices():
     """Prices management page"""
-    data = get_all_dashboard_data()
+    data = _dashboard_data_for_request()
     return render_template('dashboard/prices.html',
                          data=data,
                          admin_email=session.get('admin_email'),
@@ -2251,7 +3545,7 @@ def admin_dashboard_prices():
 @require_admin_auth
 def admin_dashboard_coupons():
     """Coupons management page"""
-    data = get_all_dashboard_data()
+    data = _dashboard_data_for_request()
     return render_template('dashboard/coupons.html',
                          data=data,
                          admin_email=session.get('admin_email'),
@@ -2261,7 +3555,7 @@ def admin_dashboard_coupons():
 @require_admin_auth
 def admin_dashboard_settings():
     """Settings page"""
-    data = get_all_dashboard_data()
+    data = _dashboard_data_for_request()
     return render_template('dashboard/settings.html',
                          data=data,
                          admin_email=session.get('admin_email'),
@@ -2271,7 +3565,7 @@ def admin_dashboard_settings():
 @require_admin_auth
 def admin_dashboard_analytics():
     """Analytics page"""
-    data = get_all_dashboard_data()
+    data = _dashboard_data_for_request()
     return render_template('dashboard/analytics.html',
                          data=data,
                          admin_email=session.get('admin_email'),
@@ -2281,7 +3575,7 @@ def admin_dashboard_analytics():
 @require_admin_auth
 def admin_dashboard_user_settings():
     """User Settings page"""
-    data = get_all_dashboard_data()
+    data = _dashboard_data_for_request()
     
     # Load user settings from JSON
     user_settings_file = 'data/dashboard/user_settings.json'
@@ -2305,7 +3599,7 @@ def admin_dashboard_user_settings():
 @require_owner_auth
 def admin_dashboard_admins():
     """Admin Management page - Owner only"""
-    data = get_all_dashboard_data()
+    data = _dashboard_data_for_request()
     settings = load_settings()
     
     return render_template('dashboard/admins.html',
@@ -2325,13 +3619,17 @@ def admin_logout():
 def admin_api_get_keys(period):
     """Get all keys for a period"""
     try:
+        file_etag = _file_etag(get_key_file_path(period))
+        if file_etag and file_etag in request.if_none_match:
+            # Key file unchanged since the client's copy; skip reading it
+            return conditional_json({}, file_etag)
         keys = get_keys_by_type(period)
-        return jsonify({
+        return conditional_json({
             'success': True,
             'period': period,
             'count': len(keys),
             'keys': keys
-        })
+        }, file_etag)
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)})
 
@@ -2347,13 +3645,16 @@ def admin_api_add_key(period):
             return jsonify({'success': False, 'message': 'Key không được để trống'})
         
         # Add key to file
-        period_map = {'1d': 'key1d.txt', '7d': 'key7d.txt', '30d': 'key30d.txt', '90d': 'key90d.txt'}
-        if period not in period_map:
+        if period not in VALID_PERIODS:
             return jsonify({'success': False, 'message': 'Period không hợp lệ'})
         
-        file_path = os.path.join('data/keys', period_map[period])
-        with open(file_path, 'a', encoding='utf-8') as f:
-            f.write(f"{key}\n")
+        # Only confirm once the batch holding the key is on disk
+        if not queue_key_append(period, key).wait(KEY_APPEND_CONFIRM_TIMEOUT):
+            return jsonify({
+                'success': False,
+                'pending': True,
+                'message': 'Chưa ghi được key vào file, hệ thống đang thử lại'
+            })
         
         return jsonify({
             'success': True,
@@ -2371,6 +3672,7 @@ def admin_api_delete_key(period, key):
         success = delete_key(key, session.get('admin_email', ''))
         
         if success:
+            invalidate_dashboard_cache()
             return jsonify({
                 'success': True,
                 'message': 'Đã xóa key thành công',
@@ -2387,17 +3689,16 @@ def admin_api_prices():
     """Get or update prices"""
     try:
         if request.method == "GET":
-            prices = load_prices()
-            return jsonify({'success': True, 'prices': prices})
+            # ETag from the stamp the (possibly TTL-cached) prices were read at
+            prices, etag = load_prices_with_etag()
+            return conditional_json({'success': True, 'prices': prices}, etag)
         else:
             data = request.get_json()
             prices = data.get('prices', {})
             
             # Save prices
-            prices_file = 'data/prices/prices.json'
-            os.makedirs(os.path.dirname(prices_file), exist_ok=True)
-            with open(prices_file, 'w', encoding='utf-8') as f:
-                json.dump(prices, f, indent=2, ensure_ascii=False)
+            dump_json_file(os.path.join("data", "prices", "prices.json"), prices)
+            invalidate_dashboard_cache()
             
             return jsonify({'success': True, 'message': 'Đã cập nhật giá thành công'})
     except Exception as e:
@@ -2409,7 +3710,7 @@ def admin_api_get_coupons():
     """Get all coupons"""
     try:
         coupons = load_coupons()
-        return jsonify({'success': True, 'coupons': coupons})
+        return conditional_json({'success': True, 'coupons': coupons})
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)})
 
@@ -2428,34 +3729,36 @@ def admin_api_add_coupon():
         if not code or not discount:
             return jsonify({'success': False, 'message': 'Mã coupon và phần trăm giảm giá là bắt buộc'})
         
-        # Load existing coupons
-        coupons = load_coupons()
-        
-        # Check if coupon code already exists
-        if code in coupons:
-            return jsonify({'success': False, 'message': 'Mã coupon đã tồn tại'})
-        
-        # Create new coupon
-        new_coupon = {
-            'discount': int(discount),
-            'type': coupon_type,
-            'created_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        }
-        
-        if coupon_type == 'limited':
-            new_coupon['uses_left'] = int(uses)
-        else:
-            new_coupon['uses_left'] = 999999  # Unlimited
-        
-        if expires_at:
-            new_coupon['expires_at'] = expires_at
-        
-        # Save coupon
-        coupons[code] = new_coupon
-        if save_coupons(coupons):
-            return jsonify({'success': True, 'message': 'Tạo coupon thành công'})
-        else:
-            return jsonify({'success': False, 'message': 'Lỗi lưu coupon'})
+        # Hold the coupon file lock across load -> modify -> save
+        with key_file_lock(COUPON_FILE):
+            # Load existing coupons
+            coupons = load_coupons()
+            
+            # Check if coupon code already exists
+            if code in coupons:
+                return jsonify({'success': False, 'message': 'Mã coupon đã tồn tại'})
+            
+            # Create new coupon
+            new_coupon = {
+                'discount': int(discount),
+                'type': coupon_type,
+                'created_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            }
+            
+            if coupon_type == 'limited':
+                new_coupon['uses_left'] = int(uses)
+            else:
+                new_coupon['uses_left'] = 999999  # Unlimited
+            
+            if expires_at:
+                new_coupon['expires_at'] = expires_at
+            
+            # Save coupon
+            coupons[code] = new_coupon
+            if save_coupons(coupons):
+                return jsonify({'success': True, 'message': 'Tạo coupon thành công'})
+            else:
+                return jsonify({'success': False, 'message': 'Lỗi lưu coupon'})
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)})
 
@@ -2467,36 +3770,38 @@ def admin_api_update_coupon(code):
         data = request.get_json()
         code = code.upper().strip()
         
-        # Load existing coupons
-        coupons = load_coupons()
-        
-        if code not in coupons:
-            return jsonify({'success': False, 'message': 'Coupon không tồn tại'})
-        
-        # Update coupon data
-        coupon = coupons[code]
-        coupon['discount'] = int(data.get('discount', coupon.get('discount', 0)))
-        coupon['type'] = data.get('type', coupon.get('type', 'limited'))
-        
-        if coupon['type'] == 'limited':
-            coupon['uses_left'] = int(data.get('uses', coupon.get('uses_left', 1)))
-        else:
-            coupon['uses_left'] = 999999
-        
-        expires_at = data.get('expires_at')
-        if expires_at:
-            coupon['expires_at'] = expires_at
-        elif 'expires_at' in coupon:
-            del coupon['expires_at']
-        
-        coupon['updated_at'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        
-        # Save updated coupons
-        coupons[code] = coupon
-        if save_coupons(coupons):
-            return jsonify({'success': True, 'message': 'Cập nhật coupon thành công'})
-        else:
-            return jsonify({'success': False, 'message': 'Lỗi lưu coupon'})
+        # Hold the coupon file lock across load -> modify -> save
+        with key_file_lock(COUPON_FILE):
+            # Load existing coupons
+            coupons = load_coupons()
+            
+            if code not in coupons:
+                return jsonify({'success': False, 'message': 'Coupon không tồn tại'})
+            
+            # Update coupon data
+            coupon = coupons[code]
+            coupon['discount'] = int(data.get('discount', coupon.get('discount', 0)))
+            coupon['type'] = data.get('type', coupon.get('type', 'limited'))
+            
+            if coupon['type'] == 'limited':
+                coupon['uses_left'] = int(data.get('uses', coupon.get('uses_left', 1)))
+            else:
+                coupon['uses_left'] = 999999
+            
+            expires_at = data.get('expires_at')
+            if expires_at:
+                coupon['expires_at'] = expires_at
+            elif 'expires_at' in coupon:
+                del coupon['expires_at']
+            
+            coupon['updated_at'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            
+            # Save updated coupons
+            coupons[code] = coupon
+            if save_coupons(coupons):
+                return jsonify({'success': True, 'message': 'Cập nhật coupon thành công'})
+            else:
+                return jsonify({'success': False, 'message': 'Lỗi lưu coupon'})
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)})
 
@@ -2507,20 +3812,22 @@ def admin_api_delete_coupon(code):
     try:
         code = code.upper().strip()
         
-        # Load existing coupons
-        coupons = load_coupons()
-        
-        if code not in coupons:
-            return jsonify({'success': False, 'message': 'Coupon không tồn tại'})
-        
-        # Remove coupon
-        del coupons[code]
-        
-        # Save updated coupons
-        if save_coupons(coupons):
-            return jsonify({'success': True, 'message': 'Xóa coupon thành công'})
-        else:
-            return jsonify({'success': False, 'message': 'Lỗi lưu dữ liệu'})
+        # Hold the coupon file lock across load -> modify -> save
+        with key_file_lock(COUPON_FILE):
+            # Load existing coupons
+            coupons = load_coupons()
+            
+            if code not in coupons:
+                return jsonify({'success': False, 'message': 'Coupon không tồn tại'})
+            
+            # Remove coupon
+            del coupons[code]
+            
+            # Save updated coupons
+            if save_coupons(coupons):
+                return jsonify({'success': True, 'message': 'Xóa coupon thành công'})
+            else:
+                return jsonify({'success': False, 'message': 'Lỗi lưu dữ liệu'})
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)})
 
@@ -2529,19 +3836,7 @@ def admin_api_delete_coupon(code):
 def admin_api_stats():
     """Get dashboard statistics"""
     try:
-        stats = {
-            'total_keys': sum(count_keys(t) for t in ['1d', '7d', '30d', '90d']),
-            'keys_by_type': {
-                '1d': count_keys('1d'),
-                '7d': count_keys('7d'),
-                '30d': count_keys('30d'),
-                '90d': count_keys('90d'),
-            },
-            'total_orders': get_total_orders(),
-            'total_coupons': len(load_coupons()),
-            'recent_orders': get_recent_orders(10)
-        }
-        return jsonify({'success': True, 'stats': stats})
+        return conditional_json({'success': True, 'stats': stats_snapshot()})
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)})
 
@@ -2550,13 +3845,9 @@ def admin_api_stats():
 def admin_api_mbbank_status():
     """Check MB Bank API status for admin dashboard"""
     try:
-        # Sử dụng route existing để check status
-        from flask import Flask
-        with app.test_client() as client:
-            response = client.get('/api/mbbank/status')
-            data = response.get_json()
-            
-        if data and data.get('status') == 'ok':
+        data = _probe_mb_api()
+        
+        if data['online']:
             return jsonify({
                 'success': True,
                 'status': 'online',
@@ -2584,35 +3875,30 @@ def admin_api_get_orders():
         status_filter = request.args.get('status', 'all')  # all, paid, pending
         limit = int(request.args.get('limit', 100))
         
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        
-        if status_filter == 'paid':
-            cursor.execute("""
-                SELECT id, uid, verification_code, email, key, promo_code, paid, created_at 
-                FROM orders 
-                WHERE paid = 1
-                ORDER BY created_at DESC 
-                LIMIT ?
-            """, (limit,))
-        elif status_filter == 'pending':
-            cursor.execute("""
-                SELECT id, uid, verification_code, email, key, promo_code, paid, created_at 
-                FROM orders 
-                WHERE paid = 0
-                ORDER BY created_at DESC 
-                LIMIT ?
-            """, (limit,))
-        else:
-            cursor.execute("""
-                SELECT id, uid, verification_code, email, key, promo_code, paid, created_at 
-                FROM orders 
-                ORDER BY created_at DESC 
-                LIMIT ?
-            """, (limit,))
-        
-        orders = cursor.fetchall()
-        conn.close()
+        with db_conn() as conn:
+            if status_filter == 'paid':
+                orders = conn.execute("""
+                    SELECT id, uid, verification_code, email, key, promo_code, paid, created_at 
+                    FROM orders 
+                    WHERE paid = 1
+                    ORDER BY created_at DESC 
+                    LIMIT ?
+                """, (limit,)).fetchall()
+            elif status_filter == 'pending':
+                orders = conn.execute("""
+                    SELECT id, uid, verification_code, email, key, promo_code, paid, created_at 
+                    FROM orders 
+                    WHERE paid = 0
+                    ORDER BY created_at DESC 
+                    LIMIT ?
+                """, (limit,)).fetchall()
+            else:
+                orders = conn.execute("""
+                    SELECT id, uid, verification_code, email, key, promo_code, paid, created_at 
+                    FROM orders 
+                    ORDER BY created_at DESC 
+                    LIMIT ?
+                """, (limit,)).fetchall()
         
         return jsonify({
             'success': True,
@@ -2671,11 +3957,8 @@ def admin_api_cleanup_orders():
 def admin_api_delete_order(uid):
     """Delete specific order"""
     try:
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM orders WHERE uid = ?", (uid,))
-        conn.commit()
-        conn.close()
+        with db_conn() as conn:
+            conn.execute("DELETE FROM orders WHERE uid = ?", (uid,))
         
         return jsonify({
             'success': True,
@@ -2740,8 +4023,8 @@ def admin_api_settings():
                 # Save auth.json if updated
                 if auth_updated:
                     try:
-                        with open(AUTH_FILE, 'w', encoding='utf-8') as f:
-                            json.dump(auth_config, f, indent=2, ensure_ascii=False)
+                        dump_json_file(AUTH_FILE, auth_config)
+                        invalidate_auth_cache()
                     except Exception as e:
                         print(f"[AUTH] Error saving auth config: {e}")
                 
@@ -2795,13 +4078,11 @@ def admin_api_clear_all_data():
         # Clear all coupons
         save_coupons({})
         
-        # Clear all keys
-        for period in ['1d', '7d', '30d', '90d']:
-            github_manager._write_file_content(
-                f'data/keys/key{period}.txt',
-                '',
-                f'Clear all {period} keys'
-            )
+        # Clear all keys (one commit for every key file)
+        github_manager.write_files(
+            {f'data/keys/key{period}.txt': '' for period in ['1d', '7d', '30d', '90d']},
+            'Clear all keys'
+        )
         
         return jsonify({
             'success': True,
@@ -3004,13 +4285,7 @@ def admin_api_get_admins():
         authorized_emails = settings.get('authorized_emails', [])
         
         # Load permissions
-        perms_file = 'data/dashboard/admins.json'
-        permissions = {}
-        
-        if os.path.exists(perms_file):
-            with open(perms_file, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                permissions = data.get('permissions', {})
+        permissions = load_admins_config().get('permissions', {})
         
         return jsonify({
             'success': True,
@@ -3053,14 +4328,13 @@ def admin_api_add_admin():
         if email in [e.lower() for e in authorized_emails]:
             return jsonify({'success': False, 'message': 'Email này đã tồn tại trong danh sách Admin'})
         
-        # Add to list
-        authorized_emails.append(email)
-        settings['authorized_emails'] = authorized_emails
+        # Add to list (a new list: the loaded one is shared with the settings cache)
+        settings['authorized_emails'] = authorized_emails + [email]
         
         # Save settings
         if save_settings(settings):
             # Create default permissions
-            perms_file = 'data/dashboard/admins.json'
+            perms_file = ADMINS_FILE
             os.makedirs(os.path.dirname(perms_file), exist_ok=True)
             
             perms_data = {'permissions': {}}
@@ -3078,8 +4352,7 @@ def admin_api_add_admin():
                 'analytics': True
             }
             
-            with open(perms_file, 'w', encoding='utf-8') as f:
-                json.dump(perms_data, f, indent=4, ensure_ascii=False)
+            dump_json_file(perms_file, perms_data)
             
             return jsonify({'success': True, 'message': 'Đã thêm admin thành công'})
         else:
@@ -3104,16 +4377,14 @@ def admin_api_delete_admin(email):
         # Save settings
         if save_settings(settings):
             # Remove permissions
-            perms_file = 'data/dashboard/admins.json'
+            perms_file = ADMINS_FILE
             if os.path.exists(perms_file):
                 with open(perms_file, 'r', encoding='utf-8') as f:
                     perms_data = json.load(f)
                 
                 if email in perms_data.get('permissions', {}):
                     del perms_data['permissions'][email]
-                    
-                    with open(perms_file, 'w', encoding='utf-8') as f:
-                        json.dump(perms_data, f, indent=4, ensure_ascii=False)
+                    dump_json_file(perms_file, perms_data)
             
             return jsonify({'success': True, 'message': 'Đã xóa admin thành công'})
         else:
@@ -3130,7 +4401,7 @@ def admin_api_update_permissions(email):
         data = request.get_json()
         permissions = data.get('permissions', {})
         
-        perms_file = 'data/dashboard/admins.json'
+        perms_file = ADMINS_FILE
         os.makedirs(os.path.dirname(perms_file), exist_ok=True)
         
         perms_data = {'permissions': {}}
@@ -3140,15 +4411,15 @@ def admin_api_update_permissions(email):
         
         perms_data['permissions'][email] = permissions
         
-        with open(perms_file, 'w', encoding='utf-8') as f:
-            json.dump(perms_data, f, indent=4, ensure_ascii=False)
+        dump_json_file(perms_file, perms_data)
         
         return jsonify({'success': True, 'message': 'Đã cập nhật quyền thành công'})
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)})
 
 # =================== Main ===================
-if __name__ == "__main__":
+def init_app_services():
+    """Prepare data files and start background services (bot, sync, cleanup)"""
     create_db()
     initialize_key_files()
     
@@ -3169,6 +4440,10 @@ if __name__ == "__main__":
     # Start auto cleanup thread
     start_auto_cleanup()
     print("[STARTUP] ✅ Auto cleanup thread started")
+
+if __name__ == "__main__":
+    # Production runs under gunicorn (see gunicorn.conf.py); this is the dev server
+    init_app_services()
     
     port = int(os.environ.get('PORT', 5550))
-    app.run(host="0.0.0.0", port=port, debug=True)
+    app.run(host="0.0.0.0", port=port, debug=bool(os.environ.get("FLASK_DEV")), threaded=True)
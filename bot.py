@@ -1,7 +1,11 @@
 import os
 import json
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import base64
+import fcntl
+import hashlib
 import threading
 import time
 from datetime import datetime, timedelta
@@ -29,6 +33,19 @@ class GitHubDataManager:
             'Authorization': f'token {self.token}',
             'Accept': 'application/vnd.github.v3+json',
         }
+        
+        # Keep-alive session so consecutive API calls reuse the TLS connection
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        self.session.mount('https://', HTTPAdapter(
+            pool_connections=4,
+            pool_maxsize=16,
+            max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 502, 503, 504])
+        ))
+        
+        # Blob SHA per file from the last read, so the write that follows skips a GET
+        self._sha_cache = {}
+        self._sha_cache_lock = threading.Lock()
 
     def _get_file_sha(self, file_path):
         """Get file SHA for update operations"""
@@ -37,7 +54,7 @@ class GitHubDataManager:
         
         try:
             url = f'{self.api_base}/repos/{self.owner}/{self.repo}/contents/{file_path}'
-            response = requests.get(url, headers=self.headers, timeout=10)
+            response = self.session.get(url, timeout=10)
             
             if response.status_code == 200:
                 return response.json().get('sha')
@@ -51,21 +68,33 @@ class GitHubDataManager:
             return None
 
     def _read_file_content(self, file_path):
-        """Read file content from GitHub"""
+        """Read file content from GitHub (also caches its blob SHA for the next write)"""
         if not self.use_github:
             return None
         
         try:
             url = f'{self.api_base}/repos/{self.owner}/{self.repo}/contents/{file_path}'
-            response = requests.get(
-                url,
-                headers={**self.headers, 'Accept': 'application/vnd.github.v3.raw'},
-                timeout=10
-            )
+            # JSON (not raw) so the same GET returns the SHA a following PUT needs
+            response = self.session.get(url, timeout=10)
             
             if response.status_code == 200:
-                return response.text
+                data = response.json()
+                if data.get('sha'):
+                    with self._sha_cache_lock:
+                        self._sha_cache[file_path] = data['sha']
+                if data.get('encoding') == 'base64':
+                    return base64.b64decode(data.get('content', '')).decode('utf-8')
+                # Files over 1 MB come back without inline content
+                raw_resp = self.session.get(
+                    url,
+                    headers={'Accept': 'application/vnd.github.v3.raw'},
+                    timeout=10
+                )
+                raw_resp.raise_for_status()
+                return raw_resp.text
             elif response.status_code == 404:
+                with self._sha_cache_lock:
+                    self._sha_cache.pop(file_path, None)
                 return ""
             else:
                 print(f"[GITHUB] Error reading file: {response.status_code}")
@@ -74,7 +103,7 @@ class GitHubDataManager:
             print(f"[GITHUB] Exception reading file: {e}")
             return None
 
-    def _write_file_content(self, file_path, content, commit_message):
+    def _write_file_content(self, file_path, content, commit_message, sha=None):
         """Write/update file content to GitHub"""
         if not self.use_github:
             return False
@@ -82,11 +111,18 @@ class GitHubDataManager:
         try:
             url = f'{self.api_base}/repos/{self.owner}/{self.repo}/contents/{file_path}'
             
-            sha = self._get_file_sha(file_path)
+            # Prefer the SHA passed in or cached by the read; fetch it only as a fallback
+            with self._sha_cache_lock:
+                cached_sha = self._sha_cache.pop(file_path, None)
+            sha = sha or cached_sha or self._get_file_sha(file_path)
+            
+            raw = content.encode('utf-8') if isinstance(content, str) else content
+            # Same bytes as the current blob (git's sha1 of "blob <len>\0<data>"): nothing to commit
+            if sha and hashlib.sha1(b'blob %d\0' % len(raw) + raw).hexdigest() == sha:
+                print(f"[GITHUB] ℹ️  {file_path} unchanged, skipping commit")
+                return True
             
-            content_b64 = base64.b64encode(
-                content.encode('utf-8') if isinstance(content, str) else content
-            ).decode('utf-8')
+            content_b64 = base64.b64encode(raw).decode('ascii')
             
             payload = {
                 'message': commit_message,
@@ -96,7 +132,14 @@ class GitHubDataManager:
             if sha:
                 payload['sha'] = sha
             
-            response = requests.put(url, headers=self.headers, json=payload, timeout=10)
+            response = self.session.put(url, json=payload, timeout=10)
+            
+            if response.status_code in (409, 422) and sha:
+                # The file changed since it was read (e.g. written by the web app); retry with its current SHA
+                fresh_sha = self._get_file_sha(file_path)
+                if fresh_sha:
+                    payload['sha'] = fresh_sha
+                    response = self.session.put(url, json=payload, timeout=10)
             
             if response.status_code in [200, 201]:
                 print(f"[GITHUB] ✅ Updated {file_path}")
@@ -265,6 +308,8 @@ def get_github_manager():
 # =================== Bot Configuration ===================
 TG_BOT_TOKEN = os.environ.get("TG_BOT_TOKEN", "")
 TG_CHAT_ID = "7454505306"
+# Keep-alive session for admin notifications
+TG_SESSION = requests.Session()
 COUPON_FILE = os.path.join("data", "coupon", "coupons.json")
 ADMIN_FILE = os.path.join("data", "admin", "admin.json")
 USERS_FILE = os.path.join("data", "users", "users.json")
@@ -285,7 +330,7 @@ def send_telegram(message):
     try:
         url = f"https://api.telegram.org/bot{TG_BOT_TOKEN}/sendMessage"
         payload = {"chat_id": TG_CHAT_ID, "text": message, "parse_mode": "HTML"}
-        r = requests.post(url, data=payload)
+        r = TG_SESSION.post(url, data=payload, timeout=10)
         return r.status_code == 200
     except Exception as e:
         print(f"[TG ERROR] {e}")
@@ -507,13 +552,21 @@ def save_coupons(coupons):
     """Save coupons to JSON file and GitHub API"""
     try:
         os.makedirs(os.path.dirname(COUPON_FILE), exist_ok=True)
-        with open(COUPON_FILE, "w", encoding="utf-8") as f:
-            json.dump(coupons, f, indent=2, ensure_ascii=False)
+        content = json.dumps(coupons, indent=2, ensure_ascii=False)
+        # Write a temp file and rename it in, under the same sidecar flock the
+        # web app's coupon writers hold, so no reader ever sees a half-written file
+        tmp_path = COUPON_FILE + ".tmp"
+        with open(COUPON_FILE + ".lock", "a") as lock_file:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(content)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, COUPON_FILE)
         
         # Update GitHub if available
         github_mgr = get_github_manager()
         if github_mgr.use_github:
-            content = json.dumps(coupons, indent=2, ensure_ascii=False)
             github_mgr._write_file_content(
                 'data/coupon/coupons.json',
                 content,
@@ -723,6 +776,25 @@ def load_shortened_urls(service):
         return {}
 
 # =================== Key Functions ===================
+# {file_path: (mtime_ns, size, keys)}: paging through /xemkey re-reads nothing
+# until the file changes
+_key_list_cache = {}
+
+def load_key_list(file_path):
+    """Non-empty, stripped keys in file_path (cached by mtime/size), [] if missing"""
+    try:
+        st = os.stat(file_path)
+    except FileNotFoundError:
+        return []
+    cached = _key_list_cache.get(file_path)
+    if cached and cached[0] == st.st_mtime_ns and cached[1] == st.st_size:
+        return cached[2]
+    
+    with open(file_path, "r", encoding="utf-8") as f:
+        keys = [line.strip() for line in f if line.strip()]
+    _key_list_cache[file_path] = (st.st_mtime_ns, st.st_size, keys)
+    return keys
+
 def get_all_unsold_keys():
     """Get all unsold keys from all key files"""
     keys_dict = {}
@@ -735,14 +807,12 @@ def get_all_unsold_keys():
     
     for filename, label in key_files.items():
         file_path = os.path.join("data", "keys", filename)
-        if os.path.exists(file_path):
-            try:
-                with open(file_path, "r", encoding="utf-8") as f:
-                    lines = [line.strip() for line in f.readlines() if line.strip()]
-                if lines:
-                    keys_dict[label] = lines
-            except Exception as e:
-                print(f"[KEY ERROR] Failed to read {filename}: {e}")
+        try:
+            lines = load_key_list(file_path)
+            if lines:
+                keys_dict[label] = list(lines)
+        except Exception as e:
+            print(f"[KEY ERROR] Failed to read {filename}: {e}")
     
     return keys_dict
 
@@ -760,13 +830,10 @@ def get_keys_by_type(period_label):
         return []
     
     file_path = os.path.join("data", "keys", filename)
-    if os.path.exists(file_path):
-        try:
-            with open(file_path, "r", encoding="utf-8") as f:
-                lines = [line.strip() for line in f.readlines() if line.strip()]
-            return lines
-        except Exception as e:
-            print(f"[KEY ERROR] Failed to read {filename}: {e}")
+    try:
+        return list(load_key_list(file_path))
+    except Exception as e:
+        print(f"[KEY ERROR] Failed to read {filename}: {e}")
     
     return []
 
@@ -0,0 +1,20 @@
+import os
+
+# One worker process: the Telegram bot poller, OTP storage and file locks live
+# in-process, so they must not be duplicated. Concurrency comes from threads,
+# which overlap the blocking SendGrid / MBBank / GitHub HTTP calls.
+bind = f"0.0.0.0:{os.environ.get('PORT', '8080')}"
+worker_class = "gthread"
+workers = 1
+threads = int(os.environ.get("GUNICORN_THREADS", 8))
+timeout = 60
+graceful_timeout = 30
+keepalive = 5
+accesslog = "-"
+errorlog = "-"
+
+
+def post_worker_init(worker):
+    """Start background services once the worker has imported the app"""
+    import app
+    app.init_app_services()
@@ -57,4 +57,4 @@ chmod -R 777 /app/data
 echo "File restoration completed"
 
 # Start the application
-exec python app.py bot.py
\ No newline at end of file
+exec gunicorn -c gunicorn.conf.py app:app
\ No newline at end of file
@@ -1,12 +1,72 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import os
 import time
+import fcntl
+import shutil
+import tempfile
 import threading
+from contextlib import contextmanager
 from datetime import datetime
 
 GITHUB_RAW_URL = "https://raw.githubusercontent.com/nddev15/keys/main"
 SYNC_INTERVAL = 300  # 5 phút (300 giây)
 
+# One keep-alive session for every sync: all files come from the same host
+SYNC_SESSION = requests.Session()
+SYNC_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=1,
+    pool_maxsize=4,
+    max_retries=Retry(total=2, backoff_factor=0.3, status_forcelist=[429, 502, 503, 504])
+))
+
+# Files app.py rewrites under key_file_lock (flock on "<path>.lock")
+LOCKED_FILES = {
+    'data/keys/key1d.txt',
+    'data/keys/key7d.txt',
+    'data/keys/key30d.txt',
+    'data/keys/key90d.txt',
+    'data/coupon/coupons.json',
+    'data/keys/keys_solved.json',
+}
+
+@contextmanager
+def _flock(local_path):
+    """Same sidecar flock as app.key_file_lock, so syncs never interleave with its writers"""
+    if local_path not in LOCKED_FILES:
+        yield
+        return
+    with open(local_path + ".lock", "a") as lock_file:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        yield
+
+def _replace_file(local_path, data):
+    """
+    Write data next to local_path and os.replace it in, so readers (which
+    don't lock key files) see the old or new file, never a truncated one.
+    Returns False if the file already had exactly this content
+    """
+    try:
+        with open(local_path, 'rb') as f:
+            if f.read() == data:
+                return False
+    except FileNotFoundError:
+        pass
+    
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(local_path), prefix='.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        if os.path.exists(local_path):
+            shutil.copymode(local_path, tmp_path)
+        os.replace(tmp_path, local_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+    return True
+
 def sync_keys_from_github():
     """Đồng bộ file keys và prices từ GitHub về server"""
     # Files cần sync
@@ -34,18 +94,18 @@ def sync_keys_from_github():
     for github_path, local_path in files_to_sync.items():
         try:
             url = f"{GITHUB_RAW_URL}/{github_path}"
-            response = requests.get(url, timeout=10)
+            response = SYNC_SESSION.get(url, timeout=10)
             
             if response.status_code == 200:
                 # Tạo thư mục nếu chưa có
                 os.makedirs(os.path.dirname(local_path), exist_ok=True)
                 
-                # Ghi file
-                with open(local_path, 'w', encoding='utf-8') as f:
-                    f.write(response.text)
+                # Ghi file (atomic, under the same lock as app.py's writers)
+                with _flock(local_path):
+                    changed = _replace_file(local_path, response.content)
                 
                 filename = os.path.basename(local_path)
-                print(f"✅ Đã sync: {filename}")
+                print(f"✅ Đã sync: {filename}" + ("" if changed else " (không đổi)"))
                 success_count += 1
             else:
                 filename = os.path.basename(local_path)